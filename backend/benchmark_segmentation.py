@@ -0,0 +1,151 @@
+"""
+Сравнение моделей сегментации (SEGMENTATION_BACKENDS) по скорости и качеству маски.
+
+Использование:
+    python benchmark_segmentation.py photos/
+    python benchmark_segmentation.py photos/ --masks masks/ --runs 3
+
+Аргументы:
+    photos/       - папка с тестовыми фото (jpg/png/webp)
+    --masks DIR   - эталонные маски (то же имя файла, .png; белый = человек).
+                    Без них IoU считается относительно маски качества 'best'
+    --qualities   - какие качества сравнивать (по умолчанию все)
+    --runs N      - сколько раз прогонять каждое фото (время - медиана и p95)
+
+Фото проходят ту же подготовку, что и в API (preprocess, FACE_WORKING_SIZE),
+сессии создаются с настройками потоков ONNX Runtime из .env.
+
+Результат:
+    - Таблица: качество, модель, время загрузки, медиана и p95 на фото, средний IoU
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+import cv2
+import numpy as np
+from rembg import remove
+
+import face_processing
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# Mask values at or above this count as foreground
+MASK_THRESHOLD = 128
+
+
+def load_images(images_dir: str):
+    """(имя, working RGB) для всех фото в папке"""
+    images = []
+    for name in sorted(os.listdir(images_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(images_dir, name), 'rb') as f:
+            _, working_rgb = face_processing.preprocess(f.read())
+        images.append((name, working_rgb))
+    return images
+
+
+def load_mask(masks_dir: str, name: str, shape):
+    path = os.path.join(masks_dir, os.path.splitext(name)[0] + '.png')
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        return None
+    height, width = shape
+    if mask.shape != (height, width):
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+    return mask >= MASK_THRESHOLD
+
+
+def segment(session, working_rgb) -> np.ndarray:
+    mask = remove(working_rgb, session=session, only_mask=True)
+    mask = np.asarray(mask)
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+    return mask >= MASK_THRESHOLD
+
+
+def iou(mask, reference) -> float:
+    union = np.logical_or(mask, reference).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(mask, reference).sum() / union)
+
+
+def benchmark(quality: str, images, runs: int):
+    """Время и маски одной модели: (load seconds, per-photo seconds, {имя: маска})"""
+    model_name = face_processing.SEGMENTATION_BACKENDS[quality]
+    started = time.perf_counter()
+    session = face_processing.create_session(model_name)
+    load_seconds = time.perf_counter() - started
+
+    # Первый прогон прогревает сессию и в замеры не входит
+    segment(session, images[0][1])
+
+    timings, masks = [], {}
+    for name, working_rgb in images:
+        for _ in range(runs):
+            started = time.perf_counter()
+            masks[name] = segment(session, working_rgb)
+            timings.append(time.perf_counter() - started)
+    return load_seconds, timings, masks
+
+
+def p95(values):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение моделей сегментации по скорости и IoU')
+    parser.add_argument('images', help='папка с тестовыми фото')
+    parser.add_argument('--masks', help='папка с эталонными масками (.png)')
+    parser.add_argument('--qualities', default=','.join(face_processing.SEGMENTATION_BACKENDS),
+                        help='качества через запятую (fast,balanced,best)')
+    parser.add_argument('--runs', type=int, default=1, help='прогонов на фото')
+    args = parser.parse_args()
+
+    qualities = [q.strip() for q in args.qualities.split(',') if q.strip()]
+    unknown = [q for q in qualities if q not in face_processing.SEGMENTATION_BACKENDS]
+    if unknown:
+        print(f'Ошибка: неизвестное качество: {", ".join(unknown)}')
+        sys.exit(1)
+
+    images = load_images(args.images)
+    if not images:
+        print(f'Ошибка: в {args.images} нет фото ({", ".join(IMAGE_EXTENSIONS)})')
+        sys.exit(1)
+
+    print(f'Фото: {len(images)}, прогонов: {args.runs}, '
+          f'потоки ONNX: intra {face_processing.INTRA_OP_THREADS} / inter {face_processing.INTER_OP_THREADS}')
+
+    results = {}
+    for quality in qualities:
+        print(f'{quality}: {face_processing.SEGMENTATION_BACKENDS[quality]}...')
+        results[quality] = benchmark(quality, images, max(1, args.runs))
+
+    # Эталон: размеченные маски, иначе маска лучшей модели
+    references = {}
+    for name, working_rgb in images:
+        reference = load_mask(args.masks, name, working_rgb.shape[:2]) if args.masks else None
+        if reference is None:
+            if 'best' not in results:
+                results['best'] = benchmark('best', images, 1)
+            reference = results['best'][2][name]
+        references[name] = reference
+    reference_label = 'эталонные маски' if args.masks else "маска 'best'"
+
+    print()
+    print(f'IoU относительно: {reference_label}')
+    print(f'{"качество":<10} {"модель":<18} {"загрузка, с":>12} {"медиана, мс":>12} {"p95, мс":>9} {"IoU":>7}')
+    for quality in qualities:
+        load_seconds, timings, masks = results[quality]
+        mean_iou = statistics.mean(iou(masks[name], references[name]) for name in masks)
+        print(f'{quality:<10} {face_processing.SEGMENTATION_BACKENDS[quality]:<18} {load_seconds:>12.2f} '
+              f'{statistics.median(timings) * 1000:>12.0f} {p95(timings) * 1000:>9.0f} {mean_iou:>7.3f}')
+
+
+if __name__ == '__main__':
+    main()
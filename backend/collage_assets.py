@@ -0,0 +1,172 @@
+"""
+Collage Assets
+Registry of pre-scaled plate and frame arrays used by the collage renderer
+
+The registry is built once at startup in the API process: every plate is
+scaled to PLATE_SIZE and stored premultiplied, together with its alpha mask
+cropped to the face box, and backage.png is scaled to the output size.
+All arrays live in one shared memory block; process-pool workers attach to
+it by name (attach_registry as pool initializer) and read zero-copy views
+instead of each decoding and scaling their own copies.
+"""
+
+import os
+import threading
+from multiprocessing import shared_memory, resource_tracker
+from typing import Dict, Optional
+
+import numpy as np
+from PIL import Image
+
+# Output dimensions - keep in sync with src/services/collage.js
+OUTPUT_WIDTH = 1100
+OUTPUT_HEIGHT = 1550
+PLATE_SIZE = 868
+FACE_WIDTH = 868
+FACE_HEIGHT = 868
+# Circle center in backage.png is at 56.4% height
+CENTER_Y_RATIO = 0.564
+
+PLATE_COUNT = 6
+ASSETS_DIR = os.getenv('ASSETS_DIR', os.path.join(os.path.dirname(__file__), '..', 'src', 'assets'))
+
+CENTER_X = OUTPUT_WIDTH / 2
+CENTER_Y = OUTPUT_HEIGHT * CENTER_Y_RATIO
+
+# Face box: the area faces are drawn into (plate-sized, centered)
+FACE_BOX = (
+    round(CENTER_X - FACE_WIDTH / 2),
+    round(CENTER_Y - FACE_HEIGHT / 2),
+    FACE_WIDTH,
+    FACE_HEIGHT,
+)
+
+
+def premultiply(rgba: np.ndarray) -> np.ndarray:
+    """Premultiply an RGBA uint8 array by its alpha"""
+    out = rgba.astype(np.uint16)
+    out[..., :3] = (out[..., :3] * out[..., 3:4] + 127) // 255
+    return out.astype(np.uint8)
+
+
+def _load_plate(index):
+    """Scale plate to cover PLATE_SIZE; returns (RGBA array, offset, alpha mask in face box)"""
+    plate = Image.open(os.path.join(ASSETS_DIR, f"plate-{index + 1}.png")).convert('RGBA')
+    scale = max(PLATE_SIZE / plate.width, PLATE_SIZE / plate.height)
+    size = (round(plate.width * scale), round(plate.height * scale))
+    plate = plate.resize(size, Image.LANCZOS)
+    offset = (round(CENTER_X - size[0] / 2), round(CENTER_Y - size[1] / 2))
+
+    # Plate alpha cropped to the face box; everything outside the plate is masked out
+    mask = Image.new('L', FACE_BOX[2:], 0)
+    mask.paste(plate.getchannel('A'), (offset[0] - FACE_BOX[0], offset[1] - FACE_BOX[1]))
+
+    return np.asarray(plate), offset, np.asarray(mask)
+
+
+def _attach_shm(name):
+    """Attach to an existing block without letting this process' resource tracker unlink it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: no track argument
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class AssetRegistry:
+    """Named read-only arrays backed by a single shared memory block"""
+
+    def __init__(self, shm, manifest: Dict, owner: bool):
+        self.shm = shm
+        self.manifest = manifest
+        self.owner = owner
+        self._arrays = {}
+        for name, (offset, shape, dtype) in manifest["arrays"].items():
+            array = np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            array.flags.writeable = False
+            self._arrays[name] = array
+
+    @classmethod
+    def build(cls) -> "AssetRegistry":
+        """Load and scale all assets, then copy them into a new shared memory block"""
+        arrays = {}
+        plate_offsets = []
+        for i in range(PLATE_COUNT):
+            plate, offset, mask = _load_plate(i)
+            arrays[f"plate-{i}"] = premultiply(plate)
+            arrays[f"mask-{i}"] = mask
+            plate_offsets.append(offset)
+
+        frame = Image.open(os.path.join(ASSETS_DIR, 'backage.png')).convert('RGBA')
+        frame = frame.resize((OUTPUT_WIDTH, OUTPUT_HEIGHT), Image.LANCZOS)
+        arrays["frame"] = premultiply(np.asarray(frame))
+
+        layout = {}
+        total = 0
+        for name, array in arrays.items():
+            layout[name] = (total, array.shape, array.dtype.str)
+            # Keep every array 64-byte aligned
+            total += (array.nbytes + 63) // 64 * 64
+
+        shm = shared_memory.SharedMemory(create=True, size=total)
+        for name, array in arrays.items():
+            offset = layout[name][0]
+            shm.buf[offset:offset + array.nbytes] = array.tobytes()
+
+        manifest = {"shm_name": shm.name, "arrays": layout, "plate_offsets": plate_offsets}
+        print(f"Collage assets loaded into shared memory ({total / 1024 / 1024:.1f} MB)")
+        return cls(shm, manifest, owner=True)
+
+    @classmethod
+    def attach(cls, manifest: Dict) -> "AssetRegistry":
+        return cls(_attach_shm(manifest["shm_name"]), manifest, owner=False)
+
+    def array(self, name: str) -> np.ndarray:
+        return self._arrays[name]
+
+    def plate(self, index: int):
+        """Premultiplied plate, its top-left offset on the canvas and its face-box mask"""
+        return (self._arrays[f"plate-{index}"],
+                tuple(self.manifest["plate_offsets"][index]),
+                self._arrays[f"mask-{index}"])
+
+    def close(self):
+        self._arrays = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+_registry: Optional[AssetRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def init_registry() -> Dict:
+    """Build the registry in the API process. Returns the manifest for workers."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = AssetRegistry.build()
+    return _registry.manifest
+
+
+def attach_registry(manifest: Dict):
+    """Process-pool initializer: map the registry built by the parent process"""
+    global _registry
+    if _registry is None:
+        _registry = AssetRegistry.attach(manifest)
+
+
+def get_registry() -> AssetRegistry:
+    if _registry is None:
+        init_registry()
+    return _registry
+
+
+def close_registry():
+    global _registry
+    if _registry is not None:
+        _registry.close()
+        _registry = None
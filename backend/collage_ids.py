@@ -0,0 +1,77 @@
+"""
+Collage IDs
+Unique, monotonic collage IDs from a local SQLite counter
+
+Each process reserves a block of COLLAGE_ID_BLOCK IDs with a single atomic
+UPDATE and hands them out from memory, so allocating is O(1) and safe across
+several API workers and kiosks sharing the database. With blocks larger than 1,
+IDs stay unique and increase within a process, but a restart skips the rest of
+its block.
+"""
+
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class CollageIdAllocator:
+    """Hands out collage IDs from blocks reserved in SQLite"""
+
+    def __init__(self, name: str = 'collage'):
+        self.name = name
+        self.db_path = os.getenv('COLLAGE_ID_DB', os.path.join(os.path.dirname(__file__), 'collage_ids.sqlite3'))
+        self.block_size = max(1, int(os.getenv('COLLAGE_ID_BLOCK', '1')))
+        # First ID of a new counter (e.g. to continue numbering from the sheet)
+        self.start = int(os.getenv('COLLAGE_ID_START', '1'))
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0  # exclusive
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def _reserve_block(self):
+        """Atomically take the next block_size IDs from the shared counter"""
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+            # BEGIN IMMEDIATE takes the write lock up front, so concurrent reservations serialize
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)", (self.name, self.start))
+            first = db.execute("SELECT value FROM counters WHERE name = ?", (self.name,)).fetchone()[0]
+            db.execute("UPDATE counters SET value = ? WHERE name = ?", (first + self.block_size, self.name))
+            db.execute("COMMIT")
+        except Exception:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+        self._next = first
+        self._end = first + self.block_size
+        self._pid = os.getpid()
+
+    def next_id(self) -> int:
+        """Allocate one ID (blocking only when a new block is reserved)"""
+        with self._lock:
+            # A forked worker must not reuse the parent's block
+            if self._next >= self._end or self._pid != os.getpid():
+                self._reserve_block()
+            collage_id = self._next
+            self._next += 1
+            return collage_id
+
+
+# Global singleton
+collage_ids = CollageIdAllocator()
@@ -0,0 +1,123 @@
+"""
+Collage Renderer
+Server-side port of createCollage (src/services/collage.js)
+
+Layers, bottom to top:
+1. plate PNG
+2. left half of face 1 + right half of face 2, aligned by eyes and
+   masked by the plate alpha channel
+3. background frame (backage.png) with a transparent circle over the plate
+4. dividing line
+
+Compositing is done on premultiplied float32 arrays; plates, masks and the
+frame come pre-scaled from the shared asset registry (collage_assets).
+"""
+
+import io
+from typing import Dict
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from collage_assets import (
+    get_registry, OUTPUT_WIDTH, OUTPUT_HEIGHT, FACE_WIDTH, FACE_HEIGHT,
+    CENTER_X, CENTER_Y, FACE_BOX,
+)
+
+# Target eye distance is ~21% of oval width, eyes at ~47% from top
+TARGET_EYE_DISTANCE_RATIO = 0.21
+TARGET_EYE_Y_RATIO = 0.47
+
+
+def _face_pixel_coords(width, height, face_info):
+    """Eye center and eye distance in pixels (mirrors getFacePixelCoords in collage.js)"""
+    if face_info and face_info.get("found"):
+        eyes = face_info.get("eyes")
+        if eyes:
+            return (eyes["center"]["x"] * width,
+                    eyes["center"]["y"] * height,
+                    eyes["distance"] * width)
+        return ((face_info["x"] + face_info["width"] / 2) * width,
+                (face_info["y"] + face_info["height"] * 0.35) * height,
+                face_info["width"] * width * 0.4)
+
+    # Fallback: assume face is roughly in the upper-middle portion
+    face_w = width * 0.5
+    face_h = height * 0.4
+    return (width * 0.25 + face_w / 2,
+            height * 0.15 + face_h * 0.35,
+            face_w * 0.4)
+
+
+def _draw_half(faces, face_image, face_info, side):
+    """Draw one half of a face into the premultiplied face-box array, aligned by eyes"""
+    eye_x, eye_y, eye_distance = _face_pixel_coords(face_image.width, face_image.height, face_info)
+    scale = (FACE_WIDTH * TARGET_EYE_DISTANCE_RATIO) / eye_distance
+
+    # Face box coordinates: eye center goes to the vertical middle line at TARGET_EYE_Y_RATIO
+    offset_x = FACE_WIDTH / 2 - eye_x * scale
+    offset_y = FACE_HEIGHT * TARGET_EYE_Y_RATIO - eye_y * scale
+
+    half_width = FACE_WIDTH // 2
+    left = 0 if side == 'left' else half_width
+    width = half_width if side == 'left' else FACE_WIDTH - half_width
+
+    # Sample only the visible half: output (u, v) -> source ((u + left - ox) / s, (v - oy) / s)
+    half = face_image.transform(
+        (width, FACE_HEIGHT),
+        Image.AFFINE,
+        (1 / scale, 0, (left - offset_x) / scale, 0, 1 / scale, -offset_y / scale),
+        resample=Image.BICUBIC
+    )
+    faces[:, left:left + width] = np.asarray(half, dtype=np.float32) / 255
+
+
+def _over(dst, src):
+    """Source-over for premultiplied float arrays, in place on dst"""
+    dst *= 1 - src[..., 3:4]
+    dst += src
+
+
+def render_collage(face1: Dict, face2: Dict, plate_index: int) -> bytes:
+    """
+    Render the final collage
+    face1/face2: processed face results ({"data": encoded cutout, "face": face info})
+    Returns PNG bytes
+    """
+    registry = get_registry()
+    plate, (plate_x, plate_y), plate_mask = registry.plate(plate_index)
+
+    canvas = np.zeros((OUTPUT_HEIGHT, OUTPUT_WIDTH, 4), dtype=np.float32)
+    plate_h, plate_w = plate.shape[:2]
+    canvas[plate_y:plate_y + plate_h, plate_x:plate_x + plate_w] = plate / np.float32(255)
+
+    # Faces: left half of person 1, right half of person 2, clipped by the plate alpha
+    faces = np.zeros((FACE_HEIGHT, FACE_WIDTH, 4), dtype=np.float32)
+    for face, side in ((face1, 'left'), (face2, 'right')):
+        # 'RGBa' is premultiplied, so resampling doesn't bleed background color into edges
+        face_image = Image.open(io.BytesIO(face["data"])).convert('RGBa')
+        _draw_half(faces, face_image, face["face"], side)
+    faces *= (plate_mask / np.float32(255))[..., None]
+
+    box_x, box_y = FACE_BOX[:2]
+    _over(canvas[box_y:box_y + FACE_HEIGHT, box_x:box_x + FACE_WIDTH], faces)
+
+    # Background frame on top (plate visible through transparent circle)
+    _over(canvas, registry.array("frame") / np.float32(255))
+
+    # Back to straight alpha for encoding
+    alpha = canvas[..., 3:4]
+    np.divide(canvas[..., :3], alpha, out=canvas[..., :3], where=alpha > 0)
+    image = Image.fromarray(np.clip(canvas * 255 + 0.5, 0, 255).astype(np.uint8), 'RGBA')
+
+    # Dividing line
+    draw = ImageDraw.Draw(image, 'RGBA')
+    draw.line(
+        [(CENTER_X, CENTER_Y - FACE_HEIGHT / 2), (CENTER_X, CENTER_Y + FACE_HEIGHT / 2)],
+        fill=(0, 0, 0, 102),
+        width=2
+    )
+
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format="PNG", compress_level=3)
+    return output_buffer.getvalue()
@@ -0,0 +1,339 @@
+"""
+Collage Storage
+Where saved collages and their variants live, and how long they are kept
+
+Objects are stored under date-sharded keys derived from the collage filename
+(collage_20250131_... -> 2025/01/31/collage_20250131_...), so no directory
+grows without bound. A small SQLite index records every object (filename,
+key, size, created, collage ID) and drives lookups and eviction: a periodic task removes
+collages older than COLLAGE_RETENTION_DAYS and then the oldest ones until
+the total size is under COLLAGE_STORAGE_MAX_MB.
+
+The backend is pluggable (STORAGE_BACKEND): 'local' writes below
+UPLOADS_DIR, 's3' talks to any S3-compatible service (boto3, optional
+dependency; S3_ENDPOINT_URL points it at a local stand-in such as MinIO).
+"""
+
+import os
+import re
+import time
+import sqlite3
+import asyncio
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    filename TEXT PRIMARY KEY,
+    collage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    collage_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS objects_collage ON objects (collage);
+CREATE INDEX IF NOT EXISTS objects_created ON objects (created_at);
+"""
+
+CONTENT_TYPES = {
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.jpg': 'image/jpeg',
+}
+
+_DATE_RE = re.compile(r'^collage_(\d{4})(\d{2})(\d{2})_')
+
+
+def shard_key(filename: str) -> str:
+    """Date-sharded key; variants share the shard of their collage"""
+    match = _DATE_RE.match(filename)
+    if match is None:
+        return f"misc/{filename}"
+    return '/'.join(match.groups() + (filename,))
+
+
+def collage_of(filename: str) -> str:
+    """Original collage filename a variant belongs to (collage_x.w320.jpg -> collage_x)"""
+    return filename.split('.', 1)[0]
+
+
+class StorageBackend:
+    """Interface for object storage backends"""
+
+    # Directory objects can be served from directly, None for remote backends
+    root: Optional[str] = None
+
+    def write_bytes(self, key: str, data: bytes):
+        raise NotImplementedError
+
+    def write_file(self, key: str, src_path: str):
+        """Store a local file; src_path is consumed"""
+        raise NotImplementedError
+
+    def read_bytes(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def url(self, key: str) -> Optional[str]:
+        """Direct download URL for remote backends"""
+        return None
+
+
+class LocalStorage(StorageBackend):
+    """Files below a local directory"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+
+    def write_bytes(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def write_file(self, key: str, src_path: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+
+    def read_bytes(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage(StorageBackend):
+    """Objects in an S3-compatible bucket"""
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: Optional[str] = None):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3', endpoint_url=endpoint_url or None)
+        self.url_expires = int(os.getenv('S3_URL_EXPIRES_SECONDS', '3600'))
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _content_type(self, key: str) -> str:
+        return CONTENT_TYPES.get(os.path.splitext(key)[1], 'application/octet-stream')
+
+    def write_bytes(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data,
+                               ContentType=self._content_type(key))
+
+    def write_file(self, key: str, src_path: str):
+        self.client.upload_file(src_path, self.bucket, self._key(key),
+                                ExtraArgs={'ContentType': self._content_type(key)})
+        os.remove(src_path)
+
+    def read_bytes(self, key: str) -> Optional[bytes]:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def url(self, key: str) -> Optional[str]:
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self._key(key)}, ExpiresIn=self.url_expires
+        )
+
+
+def create_backend(uploads_dir: str) -> StorageBackend:
+    kind = os.getenv('STORAGE_BACKEND', 'local').lower()
+    if kind == 's3':
+        return S3Storage(os.getenv('S3_BUCKET', ''), os.getenv('S3_PREFIX', ''), os.getenv('S3_ENDPOINT_URL'))
+    return LocalStorage(uploads_dir)
+
+
+class CollageStorage:
+    """Storage backend + SQLite index + retention"""
+
+    def __init__(self, uploads_dir: str):
+        self.uploads_dir = uploads_dir
+        self.backend = create_backend(uploads_dir)
+        self.db_path = os.getenv('COLLAGE_INDEX_DB', os.path.join(os.path.dirname(__file__), 'collage_index.sqlite3'))
+        self.retention_days = float(os.getenv('COLLAGE_RETENTION_DAYS', '0'))
+        self.max_bytes = int(os.getenv('COLLAGE_STORAGE_MAX_MB', '0')) * 1024 * 1024
+        self.sweep_interval = int(os.getenv('COLLAGE_SWEEP_MINUTES', '60')) * 60
+        self._task = None
+
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            # Indexes created before collage IDs were recorded lack the column
+            columns = {row['name'] for row in db.execute("PRAGMA table_info(objects)")}
+            if 'collage_id' not in columns:
+                db.execute("ALTER TABLE objects ADD COLUMN collage_id INTEGER")
+            db.execute("CREATE INDEX IF NOT EXISTS objects_collage_id ON objects (collage_id)")
+
+    @property
+    def root(self) -> Optional[str]:
+        return self.backend.root
+
+    @contextmanager
+    def _connect(self):
+        """Connection that commits on success and is always closed"""
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _index(self, filename: str, key: str, size: int, created_at: Optional[float] = None):
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO objects (filename, collage, key, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                (filename, collage_of(filename), key, size, created_at or time.time())
+            )
+
+    # --- object operations (blocking; run via asyncio.to_thread) ---
+
+    def save_bytes(self, filename: str, data: bytes):
+        key = shard_key(filename)
+        self.backend.write_bytes(key, data)
+        self._index(filename, key, len(data))
+
+    def save_file(self, filename: str, src_path: str, created_at: Optional[float] = None):
+        """Move a finished local file (e.g. a streamed upload) into storage"""
+        key = shard_key(filename)
+        size = os.path.getsize(src_path)
+        self.backend.write_file(key, src_path)
+        self._index(filename, key, size, created_at)
+
+    def locate(self, filename: str) -> Optional[str]:
+        """Storage key of a stored object, None if it isn't stored"""
+        with self._connect() as db:
+            row = db.execute("SELECT key FROM objects WHERE filename = ?", (filename,)).fetchone()
+        return row['key'] if row else None
+
+    def set_collage_id(self, filename: str, collage_id: int):
+        with self._connect() as db:
+            db.execute("UPDATE objects SET collage_id = ? WHERE filename = ?", (collage_id, filename))
+
+    def filename_for(self, collage_id: int) -> Optional[str]:
+        """Filename of the stored collage with this collage ID, None if unknown"""
+        with self._connect() as db:
+            row = db.execute("SELECT filename FROM objects WHERE collage_id = ?", (collage_id,)).fetchone()
+        return row['filename'] if row else None
+
+    def read(self, filename: str) -> Optional[bytes]:
+        key = self.locate(filename)
+        return self.backend.read_bytes(key) if key else None
+
+    def url(self, key: str) -> Optional[str]:
+        return self.backend.url(key)
+
+    def delete_collage(self, collage: str):
+        """Delete a collage together with its variants"""
+        with self._connect() as db:
+            rows = db.execute("SELECT filename, key FROM objects WHERE collage = ?", (collage,)).fetchall()
+        for row in rows:
+            self.backend.delete(row['key'])
+        with self._connect() as db:
+            db.execute("DELETE FROM objects WHERE collage = ?", (collage,))
+
+    # --- maintenance ---
+
+    def adopt_legacy(self) -> int:
+        """Move collages from the old flat uploads directory into storage"""
+        adopted = 0
+        for entry in os.scandir(self.uploads_dir):
+            if not entry.is_file() or not entry.name.startswith('collage_') or entry.name.endswith('.tmp'):
+                continue
+            try:
+                self.save_file(entry.name, entry.path, created_at=entry.stat().st_mtime)
+                adopted += 1
+            except OSError as e:
+                print(f"Failed to move {entry.name} into storage: {e}")
+        if adopted:
+            print(f"Collage storage: moved {adopted} files into date-sharded storage")
+        return adopted
+
+    def sweep(self) -> int:
+        """Apply retention and the size cap, oldest collages first. Returns collages removed."""
+        if not self.retention_days and not self.max_bytes:
+            return 0
+        with self._connect() as db:
+            collages = db.execute(
+                "SELECT collage, SUM(size) AS size, MIN(created_at) AS created FROM objects"
+                " GROUP BY collage ORDER BY created"
+            ).fetchall()
+
+        total = sum(row['size'] for row in collages)
+        cutoff = time.time() - self.retention_days * 86400
+        removed = 0
+        for row in collages:
+            expired = self.retention_days and row['created'] < cutoff
+            over_cap = self.max_bytes and total > self.max_bytes
+            if not expired and not over_cap:
+                break
+            try:
+                self.delete_collage(row['collage'])
+            except Exception as e:
+                print(f"Failed to delete collage {row['collage']}: {e}")
+                continue
+            total -= row['size']
+            removed += 1
+        if removed:
+            print(f"Collage storage: removed {removed} collages")
+        return removed
+
+    def stats(self) -> Dict:
+        with self._connect() as db:
+            row = db.execute("SELECT COUNT(DISTINCT collage) AS collages, COALESCE(SUM(size), 0) AS bytes FROM objects").fetchone()
+        return {
+            "backend": type(self.backend).__name__,
+            "collages": row['collages'],
+            "bytes": row['bytes'],
+            "retention_days": self.retention_days,
+            "max_bytes": self.max_bytes,
+        }
+
+    # --- periodic retention task ---
+
+    async def _sweeper(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"Collage storage sweep error: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def start(self):
+        await asyncio.to_thread(self.adopt_legacy)
+        self._task = asyncio.create_task(self._sweeper())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
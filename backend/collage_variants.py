@@ -0,0 +1,115 @@
+"""
+Collage Variants
+Optimized copies and thumbnails of saved collages
+
+Collages are stored as they were produced (usually a full-size lossless PNG).
+After saving, generate_variants runs in the inference pool and returns lossy
+copies that are stored next to the original:
+    collage_<...>.full.webp / collage_<...>.full.jpg     original size
+    collage_<...>.w320.webp / collage_<...>.w320.jpg     thumbnails (COLLAGE_THUMB_WIDTHS)
+GET /uploads/{filename} picks one by the Accept header and ?size=.
+"""
+
+import io
+import os
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+THUMB_WIDTHS = sorted(int(w) for w in os.getenv('COLLAGE_THUMB_WIDTHS', '320,640').split(',') if w.strip())
+WEBP_QUALITY = int(os.getenv('COLLAGE_WEBP_QUALITY', '85'))
+JPEG_QUALITY = int(os.getenv('COLLAGE_JPEG_QUALITY', '85'))
+
+# format -> (file extension, media type)
+FORMATS = {
+    'webp': ('webp', 'image/webp'),
+    'jpeg': ('jpg', 'image/jpeg'),
+}
+
+
+def is_variant(filename: str) -> bool:
+    """Variants have a size tag between the collage name and the extension"""
+    return filename.count('.') == 2
+
+
+def variant_name(filename: str, size: str, fmt: str) -> str:
+    """size is 'full' or 'w<width>'"""
+    stem = os.path.splitext(filename)[0]
+    return f"{stem}.{size}.{FORMATS[fmt][0]}"
+
+
+def parse_size(size: Optional[str]) -> Optional[str]:
+    """
+    Map the ?size= query value to a variant size tag
+    None/'full' -> 'full', 'original' -> None (serve the stored file),
+    a width in pixels -> the smallest thumbnail at least that wide, else 'full'
+    Raises ValueError for anything else
+    """
+    if size is None or size == 'full':
+        return 'full'
+    if size == 'original':
+        return None
+    width = int(size)
+    for thumb_width in THUMB_WIDTHS:
+        if thumb_width >= width:
+            return f"w{thumb_width}"
+    return 'full'
+
+
+def select_variants(filename: str, accept: str, size: Optional[str]) -> List[Tuple[str, str]]:
+    """
+    Candidate (variant filename, media type) pairs for a request, best first
+    Empty when the original should be served
+    """
+    size_tag = parse_size(size)
+    if size_tag is None:
+        return []
+    fmt = 'webp' if 'image/webp' in accept else 'jpeg'
+    media_type = FORMATS[fmt][1]
+    candidates = [(variant_name(filename, size_tag, fmt), media_type)]
+    if size_tag != 'full':
+        # Thumbnails are skipped for images narrower than the thumbnail width
+        candidates.append((variant_name(filename, 'full', fmt), media_type))
+    return candidates
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    """RGB copy for JPEG; transparent corners become black like the collage frame"""
+    if image.mode == 'RGB':
+        return image
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (0, 0, 0))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def _encode(image: Image.Image, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    if fmt == 'webp':
+        image.save(buffer, format='WEBP', quality=WEBP_QUALITY, method=4)
+    else:
+        _flatten(image).save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def generate_variants(filename: str, image_bytes: bytes) -> Dict[str, bytes]:
+    """
+    Encode the full-size and thumbnail variants of a saved collage
+    Runs in the inference pool. Returns {variant filename: encoded bytes}.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+
+    sizes = [('full', image)]
+    for width in THUMB_WIDTHS:
+        if width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            sizes.append((f"w{width}", image.resize((width, height), Image.LANCZOS)))
+
+    variants = {}
+    for size, sized in sizes:
+        for fmt in FORMATS:
+            variants[variant_name(filename, size, fmt)] = _encode(sized, fmt)
+    return variants
@@ -0,0 +1,255 @@
+"""
+Drive Uploads
+Durable SQLite queue that uploads collages to Google Drive in the background
+
+enqueue() stores the image and returns immediately. GOOGLE_DRIVE_WORKERS
+asyncio tasks upload due jobs in threads (so at most that many uploads run at
+once), retrying with exponential backoff. Public-read permissions are granted
+in batches of up to 100 files per request, or skipped entirely when the
+folder itself is shared (GOOGLE_DRIVE_FOLDER_SHARED). Jobs survive a restart;
+interrupted uploads start over once their lease expires.
+
+The API doesn't upload to Drive, so nothing starts the queue by default: a
+producer awaits start()/stop() on its event loop, like email_outbox.
+"""
+
+import os
+import time
+import sqlite3
+import asyncio
+import secrets
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from google_services import google_services, is_retryable
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    image BLOB,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    file_id TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_due ON uploads (status, next_attempt_at);
+"""
+
+# Upload statuses
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+# Uploaded, waiting for the batched permission grant
+UPLOADED = 'uploaded'
+DONE = 'done'
+FAILED = 'failed'
+
+# Drive accepts at most 100 calls in one batch request
+PERMISSION_BATCH_SIZE = 100
+
+
+class DriveUploadQueue:
+    """SQLite-backed Drive upload queue with background workers"""
+
+    def __init__(self, services=google_services):
+        self.services = services
+        self.db_path = os.getenv('GOOGLE_DRIVE_QUEUE_DB', os.path.join(os.path.dirname(__file__), 'drive_uploads.sqlite3'))
+        self.workers = int(os.getenv('GOOGLE_DRIVE_WORKERS', '2'))
+        self.max_attempts = int(os.getenv('GOOGLE_DRIVE_MAX_ATTEMPTS', '6'))
+        self.retry_base = float(os.getenv('GOOGLE_DRIVE_RETRY_BASE_SECONDS', '30'))
+        # An upload still 'uploading' after this long belongs to a process that died
+        self.lease_seconds = float(os.getenv('GOOGLE_DRIVE_LEASE_SECONDS', '900'))
+        # Folder already shared with "anyone with the link": files inherit it
+        self.folder_shared = os.getenv('GOOGLE_DRIVE_FOLDER_SHARED', 'false').lower() in ('true', '1', 'yes')
+
+        self._claim_lock = threading.Lock()
+        self._grant_lock = threading.Lock()
+        self._wakeup = None
+        self._tasks = []
+
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Connection that commits on success and is always closed"""
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # --- queue operations (blocking; run via asyncio.to_thread) ---
+
+    def enqueue(self, image_bytes: bytes, filename: str) -> str:
+        """Store an upload job; call wake() from the event loop afterwards"""
+        upload_id = secrets.token_hex(8)
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO uploads (id, filename, image, status, next_attempt_at, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (upload_id, filename, image_bytes, QUEUED, now, now, now)
+            )
+        return upload_id
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        """Mark the next due upload as uploading and return it"""
+        with self._claim_lock, self._connect() as db:
+            while True:
+                row = db.execute(
+                    "SELECT * FROM uploads WHERE status = ? AND next_attempt_at <= ? ORDER BY created_at LIMIT 1",
+                    (QUEUED, time.time())
+                ).fetchone()
+                if row is None:
+                    return None
+                # Guarded by status: other processes sharing the database may claim the same row
+                claimed = db.execute(
+                    "UPDATE uploads SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                    (UPLOADING, time.time(), row['id'], QUEUED)
+                ).rowcount
+                if claimed:
+                    return row
+
+    def _retry_or_fail(self, db, row, error: Exception, status_on_retry: str):
+        attempts = row['attempts'] + 1
+        now = time.time()
+        if is_retryable(error) and attempts < self.max_attempts:
+            status, next_attempt = status_on_retry, now + self.retry_base * 2 ** (attempts - 1)
+        else:
+            status, next_attempt = FAILED, now
+        db.execute(
+            "UPDATE uploads SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?"
+            " WHERE id = ?",
+            (status, attempts, next_attempt, str(error), now, row['id'])
+        )
+
+    def process_next(self) -> bool:
+        """Upload one due file. Returns False when nothing is due."""
+        row = self._claim()
+        if row is None:
+            return False
+        try:
+            file_id = self.services.drive_upload_file(row['image'], row['filename'])
+        except Exception as e:
+            print(f"Error uploading {row['filename']} to Google Drive: {e}")
+            with self._connect() as db:
+                self._retry_or_fail(db, row, e, QUEUED)
+            return True
+
+        status = DONE if self.folder_shared else UPLOADED
+        with self._connect() as db:
+            db.execute(
+                "UPDATE uploads SET status = ?, file_id = ?, image = NULL, last_error = NULL, next_attempt_at = ?,"
+                " updated_at = ? WHERE id = ?",
+                (status, file_id, time.time(), time.time(), row['id'])
+            )
+        print(f"File uploaded to Google Drive: {self.services.drive_public_url(file_id)}")
+        return True
+
+    def grant_permissions(self) -> int:
+        """Share uploaded files in one batch request. Returns the number of files handled."""
+        # One worker grants at a time, the others keep uploading
+        if not self._grant_lock.acquire(blocking=False):
+            return 0
+        try:
+            return self._grant_batch()
+        finally:
+            self._grant_lock.release()
+
+    def _grant_batch(self) -> int:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT * FROM uploads WHERE status = ? AND next_attempt_at <= ? ORDER BY created_at LIMIT ?",
+                (UPLOADED, time.time(), PERMISSION_BATCH_SIZE)
+            ).fetchall()
+        if not rows:
+            return 0
+
+        try:
+            errors = self.services.grant_public_read([row['file_id'] for row in rows])
+        except Exception as e:
+            errors = {row['file_id']: e for row in rows}
+
+        with self._connect() as db:
+            for row in rows:
+                error = errors.get(row['file_id'])
+                if error is None:
+                    db.execute("UPDATE uploads SET status = ?, updated_at = ? WHERE id = ?",
+                               (DONE, time.time(), row['id']))
+                else:
+                    self._retry_or_fail(db, row, error, UPLOADED)
+        return len(rows)
+
+    def recover(self):
+        """Requeue uploads interrupted by a restart (only expired leases, others may be in progress)"""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("UPDATE uploads SET status = ?, updated_at = ? WHERE status = ? AND updated_at < ?",
+                       (QUEUED, now, UPLOADING, now - self.lease_seconds))
+
+    def status(self, upload_id: str) -> Optional[Dict]:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT id, filename, status, attempts, file_id, last_error FROM uploads WHERE id = ?",
+                (upload_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'uploadId': row['id'],
+            'filename': row['filename'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'url': self.services.drive_public_url(row['file_id']) if row['status'] == DONE else None,
+            'message': row['last_error'] or '',
+        }
+
+    # --- asyncio workers ---
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _process(self) -> bool:
+        return self.process_next() or self.grant_permissions() > 0
+
+    async def _worker(self):
+        while True:
+            # Cleared before looking for work, so a wake() during the claim isn't lost
+            self._wakeup.clear()
+            try:
+                processed = await asyncio.to_thread(self._process)
+            except Exception as e:
+                print(f"Drive upload worker error: {e}")
+                processed = False
+            if not processed:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def start(self):
+        if not self.services.is_drive_configured():
+            print("Google Drive not configured, upload queue not started")
+            return
+        await asyncio.to_thread(self.recover)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"Drive upload queue started: {self.workers} workers ({self.db_path})")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+# Global singleton
+drive_uploads = DriveUploadQueue()
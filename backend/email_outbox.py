@@ -0,0 +1,286 @@
+"""
+Email Outbox
+Durable SQLite queue for outgoing collage emails
+
+/send-email only stores a submission (collage + recipients) and returns.
+Worker tasks deliver each recipient and the manager notification in the
+background, retrying with exponential backoff. Every delivery keeps its own
+status, so clients can poll it and jobs survive a restart.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import secrets
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+from email_service import email_service, PreparedCollage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    id TEXT PRIMARY KEY,
+    image BLOB,
+    recipients TEXT NOT NULL,
+    collage_info TEXT,
+    collage_url TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    submission_id TEXT NOT NULL REFERENCES submissions(id),
+    kind TEXT NOT NULL,
+    email TEXT NOT NULL,
+    customer_type TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deliveries_due ON deliveries (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS deliveries_submission ON deliveries (submission_id);
+"""
+
+# Delivery statuses
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class EmailOutbox:
+    """SQLite-backed email queue with background delivery workers"""
+
+    def __init__(self):
+        self.db_path = os.getenv('EMAIL_OUTBOX_DB', os.path.join(os.path.dirname(__file__), 'email_outbox.sqlite3'))
+        # Concurrent deliveries; EMAIL_WORKERS is the older name of the setting
+        self.workers = max(1, int(os.getenv('SMTP_MAX_PARALLEL', os.getenv('EMAIL_WORKERS', '3'))))
+        self.max_attempts = int(os.getenv('EMAIL_MAX_ATTEMPTS', '6'))
+        self.retry_base = float(os.getenv('EMAIL_RETRY_BASE_SECONDS', '15'))
+        self.retention_days = int(os.getenv('EMAIL_OUTBOX_RETENTION_DAYS', '7'))
+        # A delivery still 'sending' after this long belongs to a process that died
+        self.lease_seconds = float(os.getenv('EMAIL_LEASE_SECONDS', '600'))
+
+        self._claim_lock = threading.Lock()
+        self._wakeup = None
+        self._tasks = []
+        # Prepared messages of recent submissions, reused across their deliveries
+        self._prepared = OrderedDict()
+        self._prepared_lock = threading.Lock()
+
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            # Databases created before link-mode emails lack collage_url
+            columns = {row['name'] for row in db.execute("PRAGMA table_info(submissions)")}
+            if 'collage_url' not in columns:
+                db.execute("ALTER TABLE submissions ADD COLUMN collage_url TEXT")
+
+    @contextmanager
+    def _connect(self):
+        """Connection that commits on success and is always closed"""
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # --- queue operations (blocking; run via asyncio.to_thread) ---
+
+    def enqueue(self, image_bytes: bytes, recipients: List[Dict], collage_info: Dict = None,
+                collage_url: Optional[str] = None) -> str:
+        """
+        Store a submission with one delivery per recipient plus the manager notification
+        collage_url is the public link used by link-mode emails
+        """
+        submission_id = secrets.token_hex(8)
+        now = time.time()
+        deliveries = [('recipient', r.get('email', ''), r.get('customerType', '')) for r in recipients]
+        if email_service.manager_email:
+            deliveries.append(('manager', email_service.manager_email, ''))
+
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO submissions (id, image, recipients, collage_info, collage_url, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (submission_id, image_bytes, json.dumps(recipients), json.dumps(collage_info), collage_url, now)
+            )
+            db.executemany(
+                "INSERT INTO deliveries (submission_id, kind, email, customer_type, status, next_attempt_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(submission_id, kind, email, ctype, QUEUED, now, now) for kind, email, ctype in deliveries]
+            )
+        return submission_id
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        """Mark the next due delivery as sending and return it"""
+        with self._claim_lock, self._connect() as db:
+            while True:
+                row = db.execute(
+                    "SELECT * FROM deliveries WHERE status = ? AND next_attempt_at <= ? ORDER BY id LIMIT 1",
+                    (QUEUED, time.time())
+                ).fetchone()
+                if row is None:
+                    return None
+                # Guarded by status: other processes sharing the database may claim the same row
+                claimed = db.execute(
+                    "UPDATE deliveries SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                    (SENDING, time.time(), row['id'], QUEUED)
+                ).rowcount
+                if claimed:
+                    return row
+
+    def _load_submission(self, submission_id: str) -> sqlite3.Row:
+        with self._connect() as db:
+            return db.execute("SELECT * FROM submissions WHERE id = ?", (submission_id,)).fetchone()
+
+    def _prepared_for(self, submission) -> PreparedCollage:
+        with self._prepared_lock:
+            prepared = self._prepared.get(submission['id'])
+        if prepared is None:
+            prepared = email_service.prepare_collage(submission['image'], submission['collage_url'])
+            with self._prepared_lock:
+                self._prepared[submission['id']] = prepared
+                while len(self._prepared) > 8:
+                    self._prepared.popitem(last=False)
+        return prepared
+
+    def _deliver(self, delivery: sqlite3.Row) -> Dict:
+        """Send one delivery. Returns {success, message}."""
+        submission = self._load_submission(delivery['submission_id'])
+        prepared = self._prepared_for(submission)
+
+        if delivery['kind'] == 'manager':
+            return email_service.send_manager_notification(
+                submission['image'],
+                json.loads(submission['recipients']),
+                json.loads(submission['collage_info']),
+                prepared
+            )
+        return email_service.send_email(delivery['email'], submission['image'], delivery['customer_type'], prepared)
+
+    def _record(self, delivery: sqlite3.Row, result: Dict):
+        """Store delivery outcome, scheduling a retry with backoff on failure"""
+        attempts = delivery['attempts'] + 1
+        now = time.time()
+        if result['success']:
+            status, next_attempt, error = SENT, now, None
+        elif attempts >= self.max_attempts:
+            status, next_attempt, error = FAILED, now, result['message']
+        else:
+            status, next_attempt, error = QUEUED, now + self.retry_base * 2 ** (attempts - 1), result['message']
+
+        with self._connect() as db:
+            db.execute(
+                "UPDATE deliveries SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?"
+                " WHERE id = ?",
+                (status, attempts, next_attempt, error, now, delivery['id'])
+            )
+            # Drop the image once nothing is left to send for this submission
+            pending = db.execute(
+                "SELECT COUNT(*) FROM deliveries WHERE submission_id = ? AND status IN (?, ?)",
+                (delivery['submission_id'], QUEUED, SENDING)
+            ).fetchone()[0]
+            if not pending:
+                db.execute("UPDATE submissions SET image = NULL WHERE id = ?", (delivery['submission_id'],))
+                with self._prepared_lock:
+                    self._prepared.pop(delivery['submission_id'], None)
+
+    def process_next(self) -> bool:
+        """Deliver one due job. Returns False when nothing is due."""
+        delivery = self._claim()
+        if delivery is None:
+            return False
+        try:
+            result = self._deliver(delivery)
+        except Exception as e:
+            result = {'success': False, 'message': str(e)}
+        self._record(delivery, result)
+        return True
+
+    def recover(self):
+        """Requeue deliveries interrupted by a restart and purge old submissions"""
+        now = time.time()
+        cutoff = now - self.retention_days * 86400
+        with self._connect() as db:
+            # Only expired leases: other live processes may be sending the rest
+            db.execute("UPDATE deliveries SET status = ?, updated_at = ? WHERE status = ? AND updated_at < ?",
+                       (QUEUED, now, SENDING, now - self.lease_seconds))
+            old = "SELECT id FROM submissions WHERE created_at < ?"
+            db.execute(f"DELETE FROM deliveries WHERE submission_id IN ({old})", (cutoff,))
+            db.execute("DELETE FROM submissions WHERE created_at < ?", (cutoff,))
+
+    def status(self, submission_id: str) -> Optional[Dict]:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT kind, email, status, attempts, last_error FROM deliveries WHERE submission_id = ? ORDER BY id",
+                (submission_id,)
+            ).fetchall()
+        if not rows:
+            return None
+
+        statuses = {row['status'] for row in rows if row['kind'] == 'recipient'}
+        if statuses <= {SENT}:
+            overall = SENT
+        elif statuses <= {SENT, FAILED}:
+            overall = FAILED
+        else:
+            overall = QUEUED
+        return {
+            'jobId': submission_id,
+            'status': overall,
+            'results': [
+                {
+                    'email': row['email'],
+                    'status': row['status'],
+                    'success': row['status'] == SENT,
+                    'attempts': row['attempts'],
+                    'message': row['last_error'] or '',
+                }
+                for row in rows if row['kind'] == 'recipient'
+            ]
+        }
+
+    # --- asyncio workers ---
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _worker(self):
+        while True:
+            # Clear before looking for work: a wake() that arrives while the
+            # claim runs stays set, so the new job isn't left for the timeout
+            self._wakeup.clear()
+            try:
+                processed = await asyncio.to_thread(self.process_next)
+            except Exception as e:
+                print(f"Email outbox worker error: {e}")
+                processed = False
+            if not processed:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def start(self):
+        await asyncio.to_thread(self.recover)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"Email outbox started: {self.workers} workers ({self.db_path})")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+# Global singleton
+email_outbox = EmailOutbox()
@@ -1,14 +1,170 @@
 """
 Email Service — SMTP
-Sends emails with collage PNG attachment via SMTP
+Sends emails with collage PNG attachment (or preview + link) via SMTP
 """
 
 import os
+import io
+import time
 import smtplib
+import threading
+from contextlib import contextmanager
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
-from typing import List, Dict
+from email import policy
+from typing import List, Dict, Callable, Optional
+
+from PIL import Image
+
+# Same header encoding as as_string(), but with CRLF line endings for the wire
+SMTP_POLICY = policy.compat32.clone(linesep='\r\n')
+
+
+class TokenBucket:
+    """Blocking token-bucket rate limiter: `rate` sends per minute, bursts up to `burst` (rate 0 = no limit)"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate / 60.0
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until one is available"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SMTPConnectionPool:
+    """
+    Pool of authenticated SMTP sessions reused across recipients and requests
+
+    Idle sessions older than max_idle seconds are closed; sessions idle longer
+    than check_after seconds are verified with NOOP before reuse. A session is
+    retired after max_messages sends, since providers cap messages per session.
+    """
+
+    def __init__(self, connect: Callable[[], smtplib.SMTP], max_size: int = 4,
+                 max_idle: float = 60, check_after: float = 10, max_messages: int = 50):
+        self.connect = connect
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.max_messages = max_messages
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []  # [(server, last_used, sent_count)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _is_alive(self, server) -> bool:
+        try:
+            return server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _acquire(self):
+        """Return (server, sent_count): a healthy idle session or a new one"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, last_used, sent = self._idle.pop()
+            idle_for = time.monotonic() - last_used
+            if idle_for > self.max_idle:
+                self._close(server)
+                continue
+            if idle_for > self.check_after and not self._is_alive(server):
+                self._close(server)
+                continue
+            return server, sent
+        return self.connect(), 0
+
+    def _release(self, server, sent: int):
+        if sent >= self.max_messages:
+            self._close(server)
+            return
+        with self._lock:
+            self._idle.append((server, time.monotonic(), sent))
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a session. The session goes back to the pool on success and is
+        dropped if the block raises (it may be in an unknown protocol state).
+        """
+        self._slots.acquire()
+        try:
+            server, sent = self._acquire()
+            try:
+                yield server
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
+                # Message-level rejection: sendmail already reset the session
+                self._release(server, sent + 1)
+                raise
+            except Exception:
+                self._close(server)
+                raise
+            self._release(server, sent + 1)
+        finally:
+            self._slots.release()
+
+    def send(self, from_addr: str, to_addrs: List[str], message):
+        """Send over a pooled session, reconnecting once if the server dropped it"""
+        try:
+            with self.connection() as server:
+                server.sendmail(from_addr, to_addrs, message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # Other idle sessions were most likely dropped too
+            self.close_all()
+            with self.connection() as server:
+                server.sendmail(from_addr, to_addrs, message)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _, _ in idle:
+            self._close(server)
+
+
+class PreparedCollage:
+    """
+    Collage email encoded once and reused for every recipient
+
+    The PNG is base64-encoded into a single MIMEImage part (shared with the
+    manager notification) and the recipient message is serialized to bytes
+    once without a To header; for_recipient only prepends that header.
+    """
+
+    def __init__(self, image_part: MIMEImage, message: MIMEMultipart):
+        self.image_part = image_part
+        data = message.as_bytes(policy=SMTP_POLICY)
+        header_end = data.index(b'\r\n\r\n') + 2
+        self._headers = data[:header_end]
+        self._body = data[header_end:]
+
+    def for_recipient(self, to_email: str) -> bytes:
+        to_header = SMTP_POLICY.fold_binary('To', to_email)
+        return b''.join((to_header, self._headers, self._body))
 
 
 class EmailService:
@@ -23,6 +179,21 @@ class EmailService:
         self.from_name = os.getenv('SMTP_FROM_NAME', 'Seletti Russia')
         self.use_tls = os.getenv('SMTP_USE_TLS', 'false').lower() in ('true', '1', 'yes')
         self.manager_email = os.getenv('MANAGER_EMAIL', 'hybrid@de-light.ru')
+        # attachment: full PNG in every email; link: inline preview + link to /uploads
+        self.mode = os.getenv('EMAIL_MODE', 'attachment').lower()
+        self.preview_width = int(os.getenv('EMAIL_PREVIEW_WIDTH', '600'))
+
+        self.pool = SMTPConnectionPool(
+            self._connect,
+            max_size=int(os.getenv('SMTP_POOL_SIZE', '4')),
+            max_idle=float(os.getenv('SMTP_POOL_MAX_IDLE', '60')),
+            max_messages=int(os.getenv('SMTP_POOL_MAX_MESSAGES', '50'))
+        )
+        # Shared by all outbox workers (their count is SMTP_MAX_PARALLEL)
+        self.rate_limiter = TokenBucket(
+            rate=float(os.getenv('SMTP_RATE_PER_MINUTE', '30')),
+            burst=int(os.getenv('SMTP_RATE_BURST', '5'))
+        )
 
         if self.is_configured():
             print("Email service configured (SMTP)")
@@ -33,11 +204,71 @@ class EmailService:
         """Check if all required SMTP settings are present"""
         return bool(self.host and self.port and self.user and self.password)
 
-    def _build_message(self, to_email: str, image_bytes: bytes, customer_type: str = '') -> MIMEMultipart:
-        """Build MIME message with HTML body and PNG attachment"""
-        msg = MIMEMultipart('mixed')
+    def _connect(self) -> smtplib.SMTP:
+        """Open and authenticate a new SMTP session"""
+        if self.use_tls:
+            server = smtplib.SMTP(self.host, self.port, timeout=30)
+            server.starttls()
+        else:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+
+        try:
+            server.login(self.user, self.password)
+        except Exception:
+            SMTPConnectionPool._close(server)
+            raise
+        return server
+
+    def _send(self, to_addrs: List[str], message):
+        """Rate-limited send over a pooled session"""
+        self.rate_limiter.acquire()
+        self.pool.send(self.from_addr, to_addrs, message)
+
+    def _image_part(self, image_bytes: bytes) -> MIMEImage:
+        """PNG/WebP attachment part (base64-encoded once, shared by all messages of a collage)"""
+        subtype = 'webp' if image_bytes[8:12] == b'WEBP' else 'png'
+        img_part = MIMEImage(image_bytes, _subtype=subtype)
+        img_part.add_header('Content-Disposition', 'attachment', filename=f'seletti-hybrid.{subtype}')
+        return img_part
+
+    def _preview_part(self, image_bytes: bytes) -> MIMEImage:
+        """Small inline JPEG preview referenced from the HTML as cid:collage-preview"""
+        image = Image.open(io.BytesIO(image_bytes))
+        image.thumbnail((self.preview_width, self.preview_width * 2), Image.LANCZOS)
+        if image.mode != 'RGB':
+            # Collage corners are transparent; flatten onto the email background
+            background = Image.new('RGB', image.size, (0, 0, 0))
+            background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+            image = background
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=82, optimize=True, progressive=True)
+        preview_part = MIMEImage(buffer.getvalue(), _subtype='jpeg')
+        preview_part.add_header('Content-ID', '<collage-preview>')
+        preview_part.add_header('Content-Disposition', 'inline', filename='seletti-hybrid-preview.jpg')
+        return preview_part
+
+    def prepare_collage(self, image_bytes: bytes, collage_url: Optional[str] = None) -> PreparedCollage:
+        """
+        Encode the collage email once for all recipients
+        In link mode (EMAIL_MODE=link) recipients get an inline preview and a link
+        to collage_url instead of the full PNG; without a URL the PNG is attached
+        """
+        image_part = self._image_part(image_bytes)
+        if self.mode == 'link' and collage_url:
+            message = self._build_message(image_part, self._preview_part(image_bytes), collage_url)
+        else:
+            message = self._build_message(image_part)
+        return PreparedCollage(image_part, message)
+
+    def _build_message(self, image_part: MIMEImage, preview_part: Optional[MIMEImage] = None,
+                       collage_url: Optional[str] = None) -> MIMEMultipart:
+        """
+        Build MIME message with HTML body (To is added per recipient)
+        With preview_part: inline preview + link to collage_url, otherwise PNG attachment
+        """
+        msg = MIMEMultipart('related' if preview_part else 'mixed')
         msg['From'] = f"{self.from_name} <{self.from_addr}>"
-        msg['To'] = to_email
         msg['Subject'] = 'Ваш Seletti Hybrid'
 
         homepage_url = 'http://seletti.ru?utm_source=hybridpic&utm_medium=email&utm_campaign=hybappseletti'
@@ -45,6 +276,19 @@ class EmailService:
 
         # HTML body
         font = "'PT Sans Caption', Arial, Helvetica, sans-serif"
+        preview_rows = ''
+        if preview_part:
+            preview_rows = f"""
+          <tr>
+            <td align="center" style="padding: 0 30px 24px 30px;">
+              <a href="{collage_url}" target="_blank"><img src="cid:collage-preview" width="{self.preview_width}" alt="Seletti Hybrid" style="display: block; max-width: 100%; height: auto; border: 0;"></a>
+            </td>
+          </tr>
+          <tr>
+            <td align="center" style="padding: 0 30px 32px 30px;">
+              <a href="{collage_url}" target="_blank" style="display: inline-block; padding: 12px 24px; background-color: #FFED00; color: #000000; font-family: {font}; font-size: 14px; font-weight: bold; text-decoration: none;">Скачать в хорошем качестве</a>
+            </td>
+          </tr>"""
         html = f"""\
 <html>
 <head>
@@ -64,7 +308,7 @@ class EmailService:
             <td align="center" style="padding: 40px 30px 16px 30px;">
               <h2 style="margin: 0; color: #ffffff; font-family: {font}; font-size: 24px; font-weight: bold;">Ваш Seletti Hybrid</h2>
             </td>
-          </tr>
+          </tr>{preview_rows}
           <tr>
             <td align="center" style="padding: 0 30px 40px 30px;">
               <p style="margin: 0; color: #cccccc; font-family: {font}; font-size: 14px; line-height: 1.6;">Все коллекции на официальном сайте <a href="{seletti_url}" target="_blank" style="color: #FFED00; text-decoration: none;">seletti.ru</a></p>
@@ -83,30 +327,24 @@ class EmailService:
 </html>"""
         msg.attach(MIMEText(html, 'html', 'utf-8'))
 
-        # PNG attachment
-        img_part = MIMEImage(image_bytes, _subtype='png')
-        img_part.add_header('Content-Disposition', 'attachment', filename='seletti-hybrid.png')
-        msg.attach(img_part)
+        if preview_part:
+            msg.attach(preview_part)
+        else:
+            # PNG attachment
+            msg.attach(image_part)
 
         return msg
 
-    def send_email(self, to_email: str, image_bytes: bytes, customer_type: str = '') -> Dict:
+    def send_email(self, to_email: str, image_bytes: bytes, customer_type: str = '',
+                   prepared: Optional[PreparedCollage] = None) -> Dict:
         """Send a single email with PNG attachment. Returns {success, message}."""
         if not self.is_configured():
             return {'success': False, 'message': 'SMTP не настроен. Обратитесь к администратору.'}
 
         try:
-            msg = self._build_message(to_email, image_bytes, customer_type)
-
-            if self.use_tls:
-                server = smtplib.SMTP(self.host, self.port, timeout=30)
-                server.starttls()
-            else:
-                server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
-
-            server.login(self.user, self.password)
-            server.sendmail(self.from_addr, [to_email], msg.as_string())
-            server.quit()
+            if prepared is None:
+                prepared = self.prepare_collage(image_bytes)
+            self._send([to_email], prepared.for_recipient(to_email))
 
             print(f"Email sent to {to_email}")
             return {'success': True, 'message': 'Письмо отправлено'}
@@ -117,7 +355,7 @@ class EmailService:
             print(f"Failed to send email to {to_email}: {e}")
             return {'success': False, 'message': f'Ошибка отправки: {e}'}
 
-    def _build_manager_message(self, image_bytes: bytes, recipients: List[Dict],
+    def _build_manager_message(self, image_part: MIMEImage, recipients: List[Dict],
                                collage_info: Dict = None) -> MIMEMultipart:
         """Build MIME message for manager with collage info and recipient data"""
         msg = MIMEMultipart('mixed')
@@ -163,30 +401,21 @@ class EmailService:
         msg.attach(MIMEText(html, 'html', 'utf-8'))
 
         # PNG attachment
-        img_part = MIMEImage(image_bytes, _subtype='png')
-        img_part.add_header('Content-Disposition', 'attachment', filename='seletti-hybrid.png')
-        msg.attach(img_part)
+        msg.attach(image_part)
 
         return msg
 
     def send_manager_notification(self, image_bytes: bytes, recipients: List[Dict],
-                                   collage_info: Dict = None) -> Dict:
+                                   collage_info: Dict = None,
+                                   prepared: Optional[PreparedCollage] = None) -> Dict:
         """Send notification to manager email with collage and all data"""
         if not self.is_configured() or not self.manager_email:
             return {'success': False, 'message': 'Manager email not configured'}
 
         try:
-            msg = self._build_manager_message(image_bytes, recipients, collage_info)
-
-            if self.use_tls:
-                server = smtplib.SMTP(self.host, self.port, timeout=30)
-                server.starttls()
-            else:
-                server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
-
-            server.login(self.user, self.password)
-            server.sendmail(self.from_addr, [self.manager_email], msg.as_string())
-            server.quit()
+            image_part = prepared.image_part if prepared else self._image_part(image_bytes)
+            msg = self._build_manager_message(image_part, recipients, collage_info)
+            self._send([self.manager_email], msg.as_bytes(policy=SMTP_POLICY))
 
             print(f"Manager notification sent to {self.manager_email}")
             return {'success': True, 'message': 'Уведомление менеджеру отправлено'}
@@ -194,24 +423,6 @@ class EmailService:
             print(f"Failed to send manager notification: {e}")
             return {'success': False, 'message': f'Ошибка отправки менеджеру: {e}'}
 
-    def send_to_multiple(self, recipients: List[Dict], image_bytes: bytes) -> List[Dict]:
-        """
-        Send email to multiple recipients.
-        recipients: [{email, customerType}, ...]
-        Returns: [{email, success, message}, ...]
-        """
-        results = []
-        for r in recipients:
-            email = r.get('email', '')
-            customer_type = r.get('customerType', '')
-            result = self.send_email(email, image_bytes, customer_type)
-            results.append({
-                'email': email,
-                'success': result['success'],
-                'message': result['message']
-            })
-        return results
-
 
 # Global singleton
 email_service = EmailService()
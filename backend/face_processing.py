@@ -0,0 +1,571 @@
+"""
+Face Processing
+Background removal (rembg) and face/eye detection (MediaPipe + Haar fallback)
+
+Runs inside inference pool workers: every worker thread/process lazily loads
+its own rembg sessions and FaceLandmarker, since neither is safe to share
+between concurrent callers.
+
+Segmentation quality is selectable per request (fast | balanced | best), each
+quality maps to a rembg model (SEGMENTATION_BACKENDS). Sessions for the
+SEGMENTATION_PRELOAD qualities are loaded at warmup, others on first use.
+"""
+
+import os
+import io
+import math
+import threading
+import urllib.request
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from rembg import remove, new_session
+from rembg.sessions import sessions_class
+import onnxruntime as ort
+from PIL import Image, ImageOps
+import cv2
+import numpy as np
+import mediapipe as mp
+from mediapipe.tasks import python
+from mediapipe.tasks.python import vision
+
+# MediaPipe face landmarks indices for eyes
+# https://github.com/google/mediapipe/blob/master/mediapipe/modules/face_geometry/data/canonical_face_model_uv_visualization.png
+LEFT_EYE_CENTER = 468  # Left iris center
+RIGHT_EYE_CENTER = 473  # Right iris center
+# Fallback eye corners
+LEFT_EYE_OUTER = 33
+LEFT_EYE_INNER = 133
+RIGHT_EYE_OUTER = 362
+RIGHT_EYE_INNER = 263
+LEFT_EYE_CORNERS = [LEFT_EYE_OUTER, LEFT_EYE_INNER]
+RIGHT_EYE_CORNERS = [RIGHT_EYE_OUTER, RIGHT_EYE_INNER]
+NOSE_TIP = 1
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "face_landmarker.task")
+MODEL_URL = "https://storage.googleapis.com/mediapipe-models/face_landmarker/face_landmarker/float16/1/face_landmarker.task"
+
+# Max side (px) of the image fed to u2net and the landmarker.
+# u2net resizes to 320x320 internally, so larger inputs only cost CPU.
+WORKING_SIZE = int(os.getenv('FACE_WORKING_SIZE', '1024'))
+# Max side (px) of the returned cutout. The collage draws faces on an
+# 868px plate, so anything much bigger is wasted bandwidth.
+OUTPUT_SIZE = int(os.getenv('FACE_OUTPUT_SIZE', '1600'))
+
+# Cutout encodings: name -> (PIL format, media type, save options)
+ENCODINGS = {
+    'png': ('PNG', 'image/png', {'compress_level': 3}),
+    'webp': ('WEBP', 'image/webp', {'quality': 90, 'method': 4}),
+    'webp-lossless': ('WEBP', 'image/webp', {'lossless': True, 'quality': 50, 'method': 2}),
+}
+
+# Faces detected per image. With more than one, every face is scored and the
+# ranked list is returned so the client can pick another person without a re-take
+MAX_FACES = max(1, int(os.getenv('FACE_MAX_FACES', '1')))
+# Weights of the face ranking score components (each in 0..1)
+SCORE_WEIGHTS = {'size': 0.4, 'centrality': 0.25, 'frontalness': 0.2, 'sharpness': 0.15}
+# Where the subject is expected in the kiosk frame (relative eye center)
+FRAME_CENTER = np.array([0.5, 0.4])
+
+# Face-guided crop: u2net only segments the area around the detected face(s).
+# Margins are in face-box widths (each side) and heights (above / below,
+# below is larger to keep the shoulders). Falls back to the full frame.
+CROP_ENABLED = os.getenv('FACE_CROP', 'true').lower() in ('true', '1', 'yes')
+CROP_MARGIN_SIDE = float(os.getenv('FACE_CROP_MARGIN_SIDE', '1.2'))
+CROP_MARGIN_TOP = float(os.getenv('FACE_CROP_MARGIN_TOP', '0.9'))
+CROP_MARGIN_BOTTOM = float(os.getenv('FACE_CROP_MARGIN_BOTTOM', '2.0'))
+# Other faces join the crop only when their ranking score is at least this
+# share of the primary face's, so bystanders don't widen it to the full frame
+CROP_MIN_SCORE = float(os.getenv('FACE_CROP_MIN_SCORE', '0.8'))
+# Skip cropping when the region would cover most of the frame anyway
+CROP_MAX_AREA = 0.85
+
+# Segmentation backends: quality -> rembg model. Smaller models trade edge
+# quality for speed on CPU (u2netp ~4 MB, silueta ~43 MB, u2net ~176 MB);
+# u2net_human_seg is an alternative trained on people only
+SEGMENTATION_BACKENDS = {
+    'fast': os.getenv('SEGMENTATION_FAST', 'u2netp'),
+    'balanced': os.getenv('SEGMENTATION_BALANCED', 'silueta'),
+    'best': os.getenv('SEGMENTATION_BEST', 'u2net'),
+}
+# Quality used when the request doesn't ask for one
+DEFAULT_QUALITY = os.getenv('SEGMENTATION_QUALITY', 'best')
+if DEFAULT_QUALITY not in SEGMENTATION_BACKENDS:
+    raise ValueError(f"SEGMENTATION_QUALITY must be one of {', '.join(SEGMENTATION_BACKENDS)}")
+# Qualities whose sessions are loaded at warmup: comma-separated list or 'all'
+_preload = os.getenv('SEGMENTATION_PRELOAD', DEFAULT_QUALITY)
+PRELOAD_QUALITIES = list(SEGMENTATION_BACKENDS) if _preload == 'all' else [
+    q.strip() for q in _preload.split(',') if q.strip() in SEGMENTATION_BACKENDS
+]
+
+# ONNX Runtime threads per session. Inference workers run side by side, so by
+# default the cores are split between them instead of every session spinning
+# up one thread per core and oversubscribing the CPU
+_workers = max(1, int(os.getenv('INFERENCE_WORKERS', str(min(4, os.cpu_count() or 1)))))
+INTRA_OP_THREADS = int(os.getenv('ONNX_INTRA_OP_THREADS', str(max(1, (os.cpu_count() or 1) // _workers))))
+INTER_OP_THREADS = int(os.getenv('ONNX_INTER_OP_THREADS', '1'))
+
+# Bump when the model or pipeline output changes, to invalidate cached results
+PIPELINE_VERSION = 3
+
+# Per-worker models (one set per thread or per process)
+_models = threading.local()
+_download_lock = threading.Lock()
+
+
+def download_model():
+    """Download MediaPipe face landmarker model if not exists"""
+    with _download_lock:
+        if not os.path.exists(MODEL_PATH):
+            print(f"Downloading MediaPipe model to {MODEL_PATH}...")
+            urllib.request.urlretrieve(MODEL_URL, MODEL_PATH)
+            print("Model downloaded!")
+
+
+def create_session(model_name):
+    """rembg session for model_name with the configured ONNX Runtime thread counts"""
+    sess_opts = ort.SessionOptions()
+    sess_opts.intra_op_num_threads = INTRA_OP_THREADS
+    sess_opts.inter_op_num_threads = INTER_OP_THREADS
+    for session_class in sessions_class:
+        if session_class.name() == model_name:
+            return session_class(model_name, sess_opts)
+    # Unknown to the registry (custom models): let rembg pick the defaults
+    return new_session(model_name)
+
+
+def _worker_name():
+    return f"{os.getpid()}/{threading.current_thread().name}"
+
+
+def _load_session(models, model_name):
+    session = models.sessions.get(model_name)
+    if session is None:
+        print(f"[{_worker_name()}] Loading rembg model {model_name}...")
+        session = models.sessions[model_name] = create_session(model_name)
+    return session
+
+
+def load_models():
+    """Load rembg sessions, FaceLandmarker and Haar cascade for the current worker"""
+    if getattr(_models, "loaded", False):
+        return _models
+
+    worker = _worker_name()
+    # model name -> session; qualities mapped to the same model share it
+    _models.sessions = {}
+    for quality in PRELOAD_QUALITIES:
+        _load_session(_models, SEGMENTATION_BACKENDS[quality])
+
+    print(f"[{worker}] Loading MediaPipe face landmarker model...")
+    try:
+        download_model()
+        base_options = python.BaseOptions(model_asset_path=MODEL_PATH)
+        options = vision.FaceLandmarkerOptions(
+            base_options=base_options,
+            output_face_blendshapes=False,
+            output_facial_transformation_matrixes=False,
+            num_faces=MAX_FACES
+        )
+        _models.face_landmarker = vision.FaceLandmarker.create_from_options(options)
+        print(f"[{worker}] MediaPipe model loaded!")
+    except Exception as e:
+        print(f"[{worker}] Failed to load MediaPipe: {e}")
+        _models.face_landmarker = None
+
+    _models.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    _models.loaded = True
+    print(f"[{worker}] All models loaded!")
+    return _models
+
+
+def get_session(quality=DEFAULT_QUALITY):
+    """Segmentation session of the current worker for a quality (loaded on first use)"""
+    return _load_session(load_models(), SEGMENTATION_BACKENDS[quality])
+
+
+def cache_version(encoding, quality=DEFAULT_QUALITY):
+    """Model + parameter version string used in result cache keys"""
+    crop = f"crop{CROP_MARGIN_SIDE}-{CROP_MARGIN_TOP}-{CROP_MARGIN_BOTTOM}-{CROP_MIN_SCORE}" if CROP_ENABLED else "full"
+    return f"{SEGMENTATION_BACKENDS[quality]}/{PIPELINE_VERSION}/{WORKING_SIZE}/{OUTPUT_SIZE}/{MAX_FACES}/{crop}/{encoding}"
+
+
+def warmup():
+    """Load models in the calling worker. Returns which models are available."""
+    models = load_models()
+    return {
+        "model_loaded": all(SEGMENTATION_BACKENDS[q] in models.sessions for q in PRELOAD_QUALITIES),
+        "mediapipe_loaded": models.face_landmarker is not None,
+    }
+
+
+@dataclass
+class FaceGeometry:
+    """
+    Face box and eye positions of one detected face
+    Coordinates are relative to the analysed image (0..1), as in the API
+    """
+    box: np.ndarray        # x, y, width, height
+    left_eye: np.ndarray   # x, y
+    right_eye: np.ndarray  # x, y
+    image_size: Tuple[int, int]  # width, height in pixels
+    estimated: bool = False  # eyes guessed from the face box (Haar fallback)
+    nose: Optional[np.ndarray] = None  # x, y of the nose tip (landmarks only)
+
+    @classmethod
+    def from_landmarks(cls, points: np.ndarray, image_size) -> "FaceGeometry":
+        """points: (N, 2) array of normalized MediaPipe landmarks"""
+        low = points.min(axis=0)
+        high = points.max(axis=0)
+        if len(points) > max(LEFT_EYE_CENTER, RIGHT_EYE_CENTER):
+            # Iris landmarks (more accurate)
+            left_eye, right_eye = points[LEFT_EYE_CENTER], points[RIGHT_EYE_CENTER]
+        else:
+            # Eye corner midpoints
+            left_eye = points[LEFT_EYE_CORNERS].mean(axis=0)
+            right_eye = points[RIGHT_EYE_CORNERS].mean(axis=0)
+        nose = points[NOSE_TIP] if len(points) > NOSE_TIP else None
+        return cls(np.concatenate((low, high - low)), left_eye, right_eye, image_size, nose=nose)
+
+    @classmethod
+    def from_box(cls, box, image_size) -> "FaceGeometry":
+        """Pixel box (x, y, w, h) from the Haar cascade; eyes are estimated"""
+        size = np.array(image_size, dtype=np.float64)
+        x, y, w, h = (float(v) for v in box)
+        # Eyes roughly 35% from top, 30% and 70% from left
+        left_eye = np.array([x + w * 0.3, y + h * 0.35]) / size
+        right_eye = np.array([x + w * 0.7, y + h * 0.35]) / size
+        return cls(np.array([x, y, w, h]) / np.tile(size, 2), left_eye, right_eye, image_size, estimated=True)
+
+    @property
+    def eye_center(self) -> np.ndarray:
+        return (self.left_eye + self.right_eye) / 2
+
+    @property
+    def eye_distance(self) -> float:
+        """Inter-ocular distance in relative units (collage code scales it by image width)"""
+        return float(np.hypot(*(self.right_eye - self.left_eye)))
+
+    @property
+    def roll(self) -> float:
+        """Head roll in degrees (positive: right eye lower), measured in pixels"""
+        dx, dy = (self.right_eye - self.left_eye) * self.image_size
+        return math.degrees(math.atan2(dy, dx))
+
+    @property
+    def scale(self) -> float:
+        """Inter-ocular distance in pixels of the analysed image"""
+        return float(np.hypot(*((self.right_eye - self.left_eye) * self.image_size)))
+
+    @property
+    def frontalness(self) -> float:
+        """
+        1 for a frontal face, towards 0 as the head turns (nose tip moves
+        sideways from the eye midpoint) or tilts; 1 when landmarks are missing,
+        since the Haar cascade only finds frontal faces
+        """
+        if self.nose is None:
+            return 1.0
+        yaw = abs((self.nose - self.eye_center)[0] * self.image_size[0]) / max(self.scale, 1e-6)
+        return float(max(0.0, 1 - 2 * yaw) * math.cos(math.radians(min(abs(self.roll), 90))))
+
+    def pixel_box(self) -> Tuple[int, int, int, int]:
+        """Face box in pixels of the analysed image, clipped to it"""
+        width, height = self.image_size
+        x, y, w, h = self.box * (width, height, width, height)
+        x0, y0 = max(0, int(x)), max(0, int(y))
+        x1, y1 = min(width, int(math.ceil(x + w))), min(height, int(math.ceil(y + h)))
+        return x0, y0, max(0, x1 - x0), max(0, y1 - y0)
+
+    def to_dict(self) -> Dict:
+        """Face info as returned by the API"""
+        x, y, width, height = (float(v) for v in self.box)
+        eyes = {
+            "left": {"x": float(self.left_eye[0]), "y": float(self.left_eye[1])},
+            "right": {"x": float(self.right_eye[0]), "y": float(self.right_eye[1])},
+            "center": {"x": float(self.eye_center[0]), "y": float(self.eye_center[1])},
+            "distance": self.eye_distance,
+        }
+        if self.estimated:
+            eyes["estimated"] = True
+        return {
+            "x": x,
+            "y": y,
+            "width": width,
+            "height": height,
+            "found": True,
+            "roll": self.roll,
+            "scale": self.scale,
+            "eyes": eyes,
+        }
+
+
+def landmark_array(landmarks) -> np.ndarray:
+    """MediaPipe landmark list -> (N, 2) float array of normalized x, y"""
+    return np.array([(lm.x, lm.y) for lm in landmarks], dtype=np.float64)
+
+
+def detect_faces(rgb_img) -> List[FaceGeometry]:
+    """
+    Detect up to MAX_FACES faces in one pass using MediaPipe, falling back
+    to the Haar cascade. Expects an RGB uint8 array.
+    """
+    models = load_models()
+
+    rgb_img = np.ascontiguousarray(rgb_img)
+    height, width = rgb_img.shape[:2]
+
+    # Try MediaPipe first
+    if models.face_landmarker is not None:
+        try:
+            mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_img)
+
+            # Detect face landmarks
+            result = models.face_landmarker.detect(mp_image)
+
+            if result.face_landmarks:
+                return [FaceGeometry.from_landmarks(landmark_array(landmarks), (width, height))
+                        for landmarks in result.face_landmarks]
+        except Exception as e:
+            print(f"MediaPipe detection failed: {e}")
+
+    # Fallback to Haar cascade
+    gray = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2GRAY)
+    faces = models.face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+    faces = sorted(faces, key=lambda f: f[2] * f[3], reverse=True)[:MAX_FACES]
+
+    return [FaceGeometry.from_box(box, (width, height)) for box in faces]
+
+
+def _sharpness(gray, face: FaceGeometry) -> float:
+    """Variance of the Laplacian inside the face box"""
+    x, y, w, h = face.pixel_box()
+    if w < 3 or h < 3:
+        return 0.0
+    return float(cv2.Laplacian(gray[y:y + h, x:x + w], cv2.CV_64F).var())
+
+
+def rank_faces(rgb_img, faces: List[FaceGeometry]) -> List[Tuple[float, FaceGeometry]]:
+    """
+    Score faces by size, centrality, frontalness and sharpness (SCORE_WEIGHTS)
+    Returns (score, face) pairs, best first
+    """
+    if len(faces) < 2:
+        return [(1.0, face) for face in faces]
+
+    gray = cv2.cvtColor(np.ascontiguousarray(rgb_img), cv2.COLOR_RGB2GRAY)
+    scales = np.array([face.scale for face in faces])
+    centers = np.stack([face.eye_center for face in faces])
+    sharpness = np.array([_sharpness(gray, face) for face in faces])
+
+    components = {
+        # Relative to the biggest / sharpest face in the frame
+        'size': scales / max(scales.max(), 1e-6),
+        'sharpness': sharpness / max(sharpness.max(), 1e-6),
+        # 1 at FRAME_CENTER, falling to 0 at the frame corners
+        'centrality': 1 - np.clip(np.hypot(*(centers - FRAME_CENTER).T) / np.hypot(*FRAME_CENTER), 0, 1),
+        'frontalness': np.array([face.frontalness for face in faces]),
+    }
+    scores = sum(SCORE_WEIGHTS[name] * values for name, values in components.items())
+
+    order = np.argsort(-scores, kind='stable')
+    return [(float(scores[i]), faces[i]) for i in order]
+
+
+def face_info_from_ranked(ranked: List[Tuple[float, FaceGeometry]]) -> Dict:
+    """API face info: the best face, plus 'faces' (best first) when FACE_MAX_FACES > 1"""
+    if not ranked:
+        return {"found": False}
+
+    face_info = ranked[0][1].to_dict()
+    if MAX_FACES > 1:
+        face_info["faces"] = [dict(face.to_dict(), score=score) for score, face in ranked]
+    return face_info
+
+
+def crop_faces(ranked: List[Tuple[float, FaceGeometry]]) -> List[Tuple[float, FaceGeometry]]:
+    """The primary face and the faces scoring close to it (CROP_MIN_SCORE), best first"""
+    if not ranked:
+        return []
+    best = ranked[0][0]
+    return [(score, face) for score, face in ranked if score >= best * CROP_MIN_SCORE]
+
+
+def crop_region(faces: List[FaceGeometry]) -> Optional[np.ndarray]:
+    """
+    Relative (x0, y0, x1, y1) covering the given faces plus the crop margins
+    None when cropping is disabled, there are no faces, or the region is
+    nearly the whole frame
+    """
+    if not CROP_ENABLED or not faces:
+        return None
+    x, y, w, h = np.stack([face.box for face in faces]).T
+    region = np.array([
+        (x - w * CROP_MARGIN_SIDE).min(),
+        (y - h * CROP_MARGIN_TOP).min(),
+        (x + w * (1 + CROP_MARGIN_SIDE)).max(),
+        (y + h * (1 + CROP_MARGIN_BOTTOM)).max(),
+    ]).clip(0, 1)
+    if (region[2] - region[0]) * (region[3] - region[1]) > CROP_MAX_AREA:
+        return None
+    return region
+
+
+def _crop(rgb, region):
+    """Crop an array to a relative region. Returns (crop, exact relative region)"""
+    height, width = rgb.shape[:2]
+    x0, x1 = (int(round(v * width)) for v in region[0::2])
+    y0, y1 = (int(round(v * height)) for v in region[1::2])
+    x1, y1 = max(x1, x0 + 1), max(y1, y0 + 1)
+    exact = np.array([x0 / width, y0 / height, x1 / width, y1 / height])
+    return np.ascontiguousarray(rgb[y0:y1, x0:x1]), exact
+
+
+def _reframe_point(point, region):
+    return {
+        "x": float((point["x"] - region[0]) / (region[2] - region[0])),
+        "y": float((point["y"] - region[1]) / (region[3] - region[1])),
+    }
+
+
+def reframe_face_info(face_info: Dict, region) -> Dict:
+    """Express face info coordinates relative to a crop of the frame"""
+    if not face_info.get("found"):
+        return face_info
+    crop_w, crop_h = region[2] - region[0], region[3] - region[1]
+    reframed = dict(face_info)
+    reframed.update(_reframe_point(face_info, region))
+    reframed["width"] = float(face_info["width"] / crop_w)
+    reframed["height"] = float(face_info["height"] / crop_h)
+
+    eyes = dict(face_info["eyes"])
+    for name in ("left", "right", "center"):
+        eyes[name] = _reframe_point(eyes[name], region)
+    # Distance is measured in image widths
+    eyes["distance"] = float(eyes["distance"] / crop_w)
+    reframed["eyes"] = eyes
+    # Scale is in pixels of the analysed frame, not of the crop; the same
+    # measure is in eyes.distance, relative to the crop
+    reframed.pop("scale", None)
+
+    if "faces" in face_info:
+        reframed["faces"] = [reframe_face_info(face, region) for face in face_info["faces"]]
+    return reframed
+
+
+def _fit(size, max_side):
+    """Scale (width, height) down so the longer side is at most max_side"""
+    width, height = size
+    scale = min(1.0, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def decode_upload(contents):
+    """
+    Decode an upload once into an RGB uint8 array at output resolution
+    EXIF orientation is applied here, so every consumer sees an upright frame
+    """
+    image = Image.open(io.BytesIO(contents))
+    # Let the JPEG decoder downscale by DCT scaling when the source is huge
+    # (max side is orientation independent, so this is safe before transposing)
+    image.draft('RGB', _fit(image.size, OUTPUT_SIZE))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    rgb = np.asarray(image)
+    height, width = rgb.shape[:2]
+    output_size = _fit((width, height), OUTPUT_SIZE)
+    if output_size != (width, height):
+        rgb = cv2.resize(rgb, output_size, interpolation=cv2.INTER_AREA)
+    return rgb
+
+
+def preprocess(contents):
+    """
+    Decode an upload into two RGB arrays:
+    output (max OUTPUT_SIZE) for the cutout and working (max WORKING_SIZE) for models
+    The working array is the output array itself when no downscale is needed
+    """
+    output_rgb = decode_upload(contents)
+
+    height, width = output_rgb.shape[:2]
+    working_size = _fit((width, height), WORKING_SIZE)
+    working_rgb = output_rgb
+    if working_size != (width, height):
+        working_rgb = cv2.resize(output_rgb, working_size, interpolation=cv2.INTER_AREA)
+
+    return output_rgb, working_rgb
+
+
+def cut_out(output_rgb, working_rgb, session):
+    """
+    Segment the working array and apply the upscaled mask to the output array
+    Returns an RGBA PIL image sharing the cutout buffer
+    """
+    mask = remove(working_rgb, session=session, only_mask=True)
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+    height, width = output_rgb.shape[:2]
+    if mask.shape != (height, width):
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    rgba = np.dstack((output_rgb, mask))
+    return Image.fromarray(rgba, 'RGBA')
+
+
+def encode_image(image, encoding='png'):
+    """Encode a PIL image with one of ENCODINGS. Returns (bytes, media type)"""
+    pil_format, media_type, options = ENCODINGS[encoding]
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format=pil_format, **options)
+    return output_buffer.getvalue(), media_type
+
+
+def remove_background(contents, encoding='png', quality=DEFAULT_QUALITY):
+    """
+    Remove background from encoded image bytes
+    Returns (image bytes, media type) with transparent background
+    """
+    session = get_session(quality)
+
+    output_rgb, working_rgb = preprocess(contents)
+    cutout = cut_out(output_rgb, working_rgb, session)
+
+    return encode_image(cutout, encoding)
+
+
+def process_face(contents, encoding='png', quality=DEFAULT_QUALITY):
+    """
+    Remove background and detect face position with eye landmarks
+    Returns dict with encoded cutout, face info and output size
+    """
+    session = get_session(quality)
+
+    output_rgb, working_rgb = preprocess(contents)
+
+    # Detect face and eyes BEFORE removing background (better detection on original)
+    ranked = rank_faces(working_rgb, detect_faces(working_rgb))
+    face_info = face_info_from_ranked(ranked)
+
+    # Segment only the head-and-shoulders area around the primary face (and
+    # faces scoring close to it); output coordinates are relative to the crop,
+    # which is what the cutout shows, so faces left outside it are dropped
+    kept = crop_faces(ranked)
+    region = crop_region([face for _, face in kept])
+    if region is not None:
+        output_rgb, exact_region = _crop(output_rgb, region)
+        working_rgb, _ = _crop(working_rgb, exact_region)
+        face_info = reframe_face_info(face_info_from_ranked(kept), exact_region)
+
+    # Remove background
+    cutout = cut_out(output_rgb, working_rgb, session)
+    data, media_type = encode_image(cutout, encoding)
+
+    return {
+        "data": data,
+        "media_type": media_type,
+        "face": face_info,
+        "width": cutout.width,
+        "height": cutout.height
+    }
@@ -0,0 +1,182 @@
+"""
+Локальная заглушка Google Drive API для проверки очереди загрузок (drive_uploads.py).
+
+Использование:
+    python fake_drive_server.py --port 8081 --rate-limit-every 3
+
+    # backend/.env
+    GOOGLE_DRIVE_API_ENDPOINT=http://127.0.0.1:8081/
+    GOOGLE_DRIVE_FOLDER_ID=fake-folder
+
+Понимает ровно те запросы, которые делает бэкенд:
+    - POST /upload/drive/v3/files?uploadType=resumable   - начало resumable-загрузки
+    - PUT  <session URL>                                  - тело файла, ответ {"id": ...}
+    - POST /batch/drive/v3                                - пакет permissions.create
+    - GET  /files                                         - состояние (файлы и права) для проверки
+
+--rate-limit-every N: каждая N-я загрузка отвечает 403 userRateLimitExceeded,
+чтобы проверить повтор с backoff. Токен OAuth не проверяется; нужен только
+oauth_token.json с любым непросроченным токеном.
+"""
+
+import json
+import argparse
+import secrets
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+RATE_LIMIT_ERROR = {
+    'error': {
+        'code': 403,
+        'message': 'User Rate Limit Exceeded',
+        'errors': [{'domain': 'usageLimits', 'reason': 'userRateLimitExceeded', 'message': 'User Rate Limit Exceeded'}],
+    }
+}
+
+
+class FakeDrive:
+    """Файлы и права в памяти"""
+
+    def __init__(self, rate_limit_every: int = 0):
+        self.rate_limit_every = rate_limit_every
+        self.sessions = {}  # upload_id -> metadata
+        self.files = {}  # file_id -> {name, parents, size, permissions}
+        self.uploads = 0
+        self.lock = threading.Lock()
+
+
+class Handler(BaseHTTPRequestHandler):
+    drive: FakeDrive = None
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _json(self, status: int, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/files':
+            with self.drive.lock:
+                return self._json(200, self.drive.files)
+        self._json(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self._body()
+        if url.path == '/upload/drive/v3/files':
+            return self._start_upload(body)
+        if url.path == '/batch/drive/v3':
+            return self._batch(body)
+        self._json(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        body = self._body()
+        upload_id = parse_qs(url.query).get('upload_id', [''])[0]
+        with self.drive.lock:
+            metadata = self.drive.sessions.pop(upload_id, None)
+        if metadata is None:
+            return self._json(404, {'error': {'code': 404, 'message': 'Unknown upload session'}})
+        file_id = secrets.token_hex(8)
+        with self.drive.lock:
+            self.drive.files[file_id] = {
+                'name': metadata.get('name'),
+                'parents': metadata.get('parents', []),
+                'size': len(body),
+                'permissions': [],
+            }
+        print(f"Uploaded {metadata.get('name')} ({len(body)} bytes) -> {file_id}")
+        self._json(200, {'id': file_id})
+
+    def _start_upload(self, body: bytes):
+        with self.drive.lock:
+            self.drive.uploads += 1
+            limited = self.drive.rate_limit_every and self.drive.uploads % self.drive.rate_limit_every == 0
+        if limited:
+            print("Upload rejected: 403 userRateLimitExceeded")
+            return self._json(403, RATE_LIMIT_ERROR)
+
+        upload_id = secrets.token_hex(8)
+        with self.drive.lock:
+            self.drive.sessions[upload_id] = json.loads(body or b'{}')
+        host = self.headers.get('Host')
+        location = f"http://{host}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+        self._json(200, {}, headers={'Location': location})
+
+    def _batch(self, body: bytes):
+        """Ответ на multipart/mixed пакет: каждая часть - вложенный HTTP-запрос permissions.create"""
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + self.headers.get('Content-Type', '').encode() + b'\r\n\r\n' + body
+        )
+        boundary = secrets.token_hex(12)
+        parts = []
+        for part in message.iter_parts():
+            content_id = part.get('Content-ID', '').strip('<>')
+            request_line = part.get_payload(decode=True).split(b'\r\n', 1)[0].decode()
+            path = request_line.split(' ')[1]
+            # /drive/v3/files/<file_id>/permissions
+            segments = urlparse(path).path.strip('/').split('/')
+            file_id = segments[3] if len(segments) > 4 and segments[4] == 'permissions' else ''
+
+            with self.drive.lock:
+                entry = self.drive.files.get(file_id)
+                if entry is not None:
+                    entry['permissions'].append({'type': 'anyone', 'role': 'reader'})
+            if entry is None:
+                status, data = '404 Not Found', {'error': {'code': 404, 'message': f'File not found: {file_id}'}}
+            else:
+                status, data = '200 OK', {'kind': 'drive#permission', 'id': 'anyoneWithLink', 'type': 'anyone', 'role': 'reader'}
+
+            payload = json.dumps(data)
+            parts.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n"
+                f"Content-Length: {len(payload)}\r\n\r\n"
+                f"{payload}\r\n"
+            )
+        print(f"Batch: {len(parts)} permission requests")
+
+        response = (''.join(parts) + f"--{boundary}--\r\n").encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальная заглушка Google Drive API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='каждая N-я загрузка отвечает 403 userRateLimitExceeded (0 - никогда)')
+    args = parser.parse_args()
+
+    Handler.drive = FakeDrive(args.rate_limit_every)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"Fake Google Drive: http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -4,22 +4,197 @@ Handles uploading to Google Drive and writing to Google Sheets
 
 Drive uses OAuth2 user credentials (refresh token) because Service Accounts
 no longer have storage quota on free Gmail accounts.
-Sheets uses Service Account credentials.
+Sheets uses Service Account credentials. Rows are buffered by SheetWriter
+and written in batches (one append call per batch).
+Drive uploads can run in the background through drive_uploads.DriveUploadQueue.
 """
 
 import os
 import io
 import json
+import time
+import atexit
+import threading
+import mimetypes
 from datetime import datetime
-from typing import Optional, Dict
+from typing import Optional, Dict, List
+
+import httplib2
+import google_auth_httplib2
 
 from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.http import MediaIoBaseUpload
 from googleapiclient.errors import HttpError
 
+from collage_ids import collage_ids
+
+
+# Drive reports per-user and per-project rate limits as 403 with these reasons
+RATE_LIMIT_REASONS = {'userRateLimitExceeded', 'rateLimitExceeded'}
+
+
+def error_reasons(error: HttpError) -> set:
+    """Reasons listed in an API error response ({"error": {"errors": [{"reason": ...}]}})"""
+    details = getattr(error, 'error_details', None)
+    if not isinstance(details, list):
+        return set()
+    return {detail.get('reason') for detail in details if isinstance(detail, dict)}
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Quota (429, 403 rate limits) and server (5xx) errors are retried,
+    as are network and auth refresh failures
+    """
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 403:
+            return bool(error_reasons(error) & RATE_LIMIT_REASONS)
+        return status == 429 or status >= 500
+    return True
+
+
+def is_config_error(error: Exception) -> bool:
+    """Auth, permission or not-found errors: fixed by correcting the setup, not the request"""
+    return isinstance(error, HttpError) and error.resp.status in (401, 403, 404)
+
+
+class SheetWriter:
+    """
+    Buffered writer for Google Sheets rows
+    Rows are appended to a local JSONL spool and an in-memory buffer, then
+    flushed by a background thread as one multi-row append when
+    SHEETS_BATCH_SIZE rows are waiting or SHEETS_FLUSH_SECONDS have passed.
+    Quota/server errors, and setup errors (no access, wrong spreadsheet ID),
+    are retried with exponential backoff; the spool keeps unsent rows across
+    restarts. A batch the API rejects as malformed is moved to the dead-letter
+    file (same JSONL format, append it to the spool to resend).
+    """
+
+    def __init__(self, append_rows):
+        self.append_rows = append_rows
+        self.spool_path = os.getenv('SHEETS_SPOOL_PATH', os.path.join(os.path.dirname(__file__), 'sheets_spool.jsonl'))
+        self.dead_letter_path = os.getenv('SHEETS_DEAD_LETTER_PATH', os.path.join(os.path.dirname(__file__), 'sheets_failed.jsonl'))
+        self.batch_size = int(os.getenv('SHEETS_BATCH_SIZE', '50'))
+        self.flush_seconds = float(os.getenv('SHEETS_FLUSH_SECONDS', '5'))
+        self.retry_base = float(os.getenv('SHEETS_RETRY_BASE_SECONDS', '2'))
+        self.retry_max = float(os.getenv('SHEETS_RETRY_MAX_SECONDS', '300'))
+
+        self._rows: List[List[str]] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._failures = 0
+        self._next_attempt = 0.0
+        self._thread = None
+
+        self._load_spool()
+
+    def _load_spool(self):
+        """Restore rows left unsent by a previous run"""
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        self._rows.append(json.loads(line))
+                    except ValueError:
+                        print(f"Skipping corrupt Sheets spool line: {line[:80]}")
+        if self._rows:
+            print(f"Sheets writer: {len(self._rows)} unsent rows restored")
+
+    def _rewrite_spool(self):
+        """Replace the spool with the current buffer (call with the lock held)"""
+        tmp_path = f"{self.spool_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for row in self._rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.spool_path)
+
+    def _dead_letter(self, batch: List[List[str]]):
+        with open(self.dead_letter_path, 'a') as f:
+            for row in batch:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    def add(self, row: List[str]):
+        with self._lock:
+            self._rows.append(row)
+            with open(self.spool_path, 'a') as f:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            if len(self._rows) >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self) -> bool:
+        """Send one batch. Returns True if anything was sent."""
+        with self._lock:
+            batch = self._rows[:self.batch_size]
+        if not batch or time.time() < self._next_attempt:
+            return False
+
+        try:
+            self.append_rows(batch)
+        except Exception as e:
+            if is_retryable(e) or is_config_error(e):
+                self._failures += 1
+                delay = min(self.retry_max, self.retry_base * 2 ** (self._failures - 1))
+                self._next_attempt = time.time() + delay
+                print(f"Error writing to Google Sheets (retry in {delay:.0f}s): {e}")
+                return False
+            # Retrying a malformed request would block every later row: set it aside
+            try:
+                self._dead_letter(batch)
+            except OSError as write_error:
+                print(f"Failed to write Sheets dead-letter file: {write_error}")
+                return False
+            print(f"Moved {len(batch)} Sheets rows to {self.dead_letter_path} after non-retryable error: {e}")
+
+        self._failures = 0
+        self._next_attempt = 0.0
+        with self._lock:
+            # Only this thread removes rows, so the batch is still at the front
+            del self._rows[:len(batch)]
+            self._rewrite_spool()
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            # Keep flushing while full batches are waiting
+            while self.flush() and len(self._rows) >= self.batch_size:
+                pass
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def start(self):
+        """Start the flush thread (idempotent, safe to call from any thread)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='sheets-writer', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the thread and try to send what is left (unsent rows stay in the spool)"""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join(timeout=10)
+        self._thread = None
+        self._next_attempt = 0.0
+        while self._rows and self.flush():
+            pass
+
 
 class GoogleServices:
     """Handles Google Drive and Google Sheets operations"""
@@ -31,10 +206,20 @@ class GoogleServices:
         self.sheets_service = None
         self.drive_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID', '')
         self.sheets_id = os.getenv('GOOGLE_SHEETS_ID', '')
+        # Override the Drive API root, e.g. to point uploads at a local fake server
+        self.drive_api_endpoint = os.getenv('GOOGLE_DRIVE_API_ENDPOINT', '')
+        # Per-thread HTTP connections for the shared Drive client (httplib2 is not thread-safe)
+        self._drive_http = threading.local()
 
         # Initialize services
         self._initialize_credentials()
 
+        # The flush thread starts with the first queued row, or right away
+        # when a previous run left unsent rows in the spool
+        self.sheet_writer = SheetWriter(self.append_rows)
+        if self.is_sheets_configured() and self.sheet_writer.pending:
+            self.sheet_writer.start()
+
     def _initialize_credentials(self):
         """Initialize Google API credentials"""
         # --- Service Account for Sheets ---
@@ -81,7 +266,18 @@ class GoogleServices:
                 # Set quota project to avoid 403 with gcloud client ID
                 self.drive_credentials = self.drive_credentials.with_quota_project('seletti-hybrid')
 
-                self.drive_service = build('drive', 'v3', credentials=self.drive_credentials)
+                # Built once: the discovery document is bundled (static_discovery) and the
+                # credentials object is refreshed in place, so the client is never rebuilt
+                if self.drive_api_endpoint:
+                    # api_endpoint alone would leave uploads and batch requests on
+                    # googleapis.com, so the root URL of the bundled document is replaced
+                    document = json.loads(get_static_doc('drive', 'v3'))
+                    document['rootUrl'] = self.drive_api_endpoint.rstrip('/') + '/'
+                    document.pop('mtlsRootUrl', None)
+                    self.drive_service = build_from_document(document, credentials=self.drive_credentials)
+                else:
+                    self.drive_service = build('drive', 'v3', credentials=self.drive_credentials,
+                                               static_discovery=True)
                 print("Google Drive initialized (OAuth2 user token)")
             except Exception as e:
                 print(f"Failed to initialize Drive OAuth2: {e}")
@@ -103,58 +299,84 @@ class GoogleServices:
         """Check if Google Sheets is configured"""
         return self.sheets_service is not None and bool(self.sheets_id)
 
+    def drive_http(self) -> google_auth_httplib2.AuthorizedHttp:
+        """
+        HTTP connection of the current thread for Drive requests
+        All threads share self.drive_credentials; AuthorizedHttp refreshes
+        the expired token in place and retries the request
+        """
+        http = getattr(self._drive_http, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.drive_credentials, http=httplib2.Http(timeout=120))
+            self._drive_http.http = http
+        return http
+
+    @staticmethod
+    def drive_public_url(file_id: str) -> str:
+        # Format: https://drive.google.com/file/d/FILE_ID/view
+        return f"https://drive.google.com/file/d/{file_id}/view"
+
+    def drive_upload_file(self, image_bytes: bytes, filename: str) -> str:
+        """Upload one file into the Drive folder (resumable). Returns the file ID, raises on error."""
+        mimetype = mimetypes.guess_type(filename)[0] or 'image/png'
+        file_metadata = {
+            'name': filename,
+            'parents': [self.drive_folder_id],
+            'mimeType': mimetype
+        }
+        media = MediaIoBaseUpload(
+            io.BytesIO(image_bytes),
+            mimetype=mimetype,
+            resumable=True
+        )
+        file = self.drive_service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id'
+        ).execute(http=self.drive_http(), num_retries=2)
+        return file['id']
+
+    def grant_public_read(self, file_ids: List[str]) -> Dict[str, Optional[Exception]]:
+        """
+        Make files readable by anyone with the link, in one batch request
+        (Drive allows up to 100 calls per batch). Returns {file_id: error or None}.
+        """
+        errors = {}
+
+        def callback(request_id, response, exception):
+            errors[request_id] = exception
+
+        batch = self.drive_service.new_batch_http_request(callback=callback)
+        for file_id in file_ids:
+            batch.add(
+                self.drive_service.permissions().create(
+                    fileId=file_id,
+                    body={'type': 'anyone', 'role': 'reader'}
+                ),
+                request_id=file_id
+            )
+        batch.execute(http=self.drive_http())
+        return errors
+
     def upload_to_drive(self, image_bytes: bytes, filename: str) -> Optional[str]:
         """
-        Upload image to Google Drive folder
+        Upload image to Google Drive folder (blocking)
         Returns public URL to the file or None if failed
+        Prefer drive_uploads.enqueue (with the queue started), which uploads in the background
         """
         if not self.is_drive_configured():
             print("Google Drive not configured")
             return None
 
         try:
-            # Refresh OAuth token if needed
-            if self.drive_credentials and (self.drive_credentials.expired or not self.drive_credentials.valid):
-                self.drive_credentials.refresh(Request())
-                self.drive_credentials = self.drive_credentials.with_quota_project('seletti-hybrid')
-                self.drive_service = build('drive', 'v3', credentials=self.drive_credentials)
-
-            # Create file metadata
-            file_metadata = {
-                'name': filename,
-                'parents': [self.drive_folder_id],
-                'mimeType': 'image/png'
-            }
-
-            # Create media upload
-            media = MediaIoBaseUpload(
-                io.BytesIO(image_bytes),
-                mimetype='image/png',
-                resumable=True
-            )
-
-            # Upload file
-            file = self.drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, webViewLink, webContentLink'
-            ).execute()
-
-            file_id = file.get('id')
+            file_id = self.drive_upload_file(image_bytes, filename)
 
             # Make file publicly accessible
-            self.drive_service.permissions().create(
-                fileId=file_id,
-                body={
-                    'type': 'anyone',
-                    'role': 'reader'
-                }
-            ).execute()
-
-            # Get link to view image
-            # Format: https://drive.google.com/file/d/FILE_ID/view
-            public_url = f"https://drive.google.com/file/d/{file_id}/view"
+            error = self.grant_public_read([file_id]).get(file_id)
+            if error is not None:
+                raise error
 
+            public_url = self.drive_public_url(file_id)
             print(f"File uploaded to Google Drive: {public_url}")
             return public_url
 
@@ -167,7 +389,7 @@ class GoogleServices:
 
     def append_to_sheet(self, data: Dict) -> bool:
         """
-        Append row to Google Sheet
+        Queue a row for Google Sheets (written in batches by sheet_writer)
         Expected data format:
         {
             'collage_id': int or str,
@@ -181,63 +403,34 @@ class GoogleServices:
             print("Google Sheets not configured")
             return False
 
-        try:
-            # Prepare row data
-            values = [[
-                str(data.get('collage_id', '')),
-                data.get('datetime', ''),
-                data.get('email', ''),
-                data.get('customer_type', ''),
-                data.get('collage_url', '')
-            ]]
-
-            body = {
-                'values': values
-            }
-
-            # Append to sheet
-            result = self.sheets_service.spreadsheets().values().append(
-                spreadsheetId=self.sheets_id,
-                range='A:E',  # Columns A through E
-                valueInputOption='RAW',
-                insertDataOption='INSERT_ROWS',
-                body=body
-            ).execute()
-
-            print(f"Row appended to Google Sheets: {result.get('updates')}")
-            return True
-
-        except HttpError as error:
-            print(f"Error writing to Google Sheets: {error}")
-            return False
-        except Exception as e:
-            print(f"Unexpected error writing to Sheets: {e}")
-            return False
+        self.sheet_writer.start()
+        self.sheet_writer.add([
+            str(data.get('collage_id', '')),
+            data.get('datetime', ''),
+            data.get('email', ''),
+            data.get('customer_type', ''),
+            data.get('collage_url', '')
+        ])
+        return True
+
+    def append_rows(self, values: List[List[str]]):
+        """Append rows to the sheet in one request (raises on error)"""
+        result = self.sheets_service.spreadsheets().values().append(
+            spreadsheetId=self.sheets_id,
+            range='A:E',  # Columns A through E
+            valueInputOption='RAW',
+            insertDataOption='INSERT_ROWS',
+            body={'values': values}
+        ).execute()
+
+        print(f"{len(values)} rows appended to Google Sheets: {result.get('updates')}")
 
     def get_next_collage_id(self) -> int:
         """
-        Get next collage ID by counting rows in sheet
-        Returns 1 if sheet is empty or on error
+        Get next collage ID from the local allocator (no sheet scan)
+        Set COLLAGE_ID_START to continue numbering of an existing sheet
         """
-        if not self.is_sheets_configured():
-            return 1
-
-        try:
-            # Get all values from column A (IDs)
-            result = self.sheets_service.spreadsheets().values().get(
-                spreadsheetId=self.sheets_id,
-                range='A:A'
-            ).execute()
-
-            values = result.get('values', [])
-
-            # First row is header, so actual data rows = len(values) - 1
-            # Next ID = number of data rows + 1
-            return len(values) if len(values) > 0 else 1
-
-        except Exception as e:
-            print(f"Error getting next collage ID: {e}")
-            return 1
+        return collage_ids.next_id()
 
 
 # Global instance
@@ -0,0 +1,128 @@
+"""
+Inference Pool
+Runs CPU-heavy model inference off the event loop
+
+Jobs are executed in a thread or process pool (INFERENCE_MODE). Each worker
+keeps its own models (see face_processing.load_models). The number of jobs
+running plus waiting is bounded: once INFERENCE_WORKERS + INFERENCE_QUEUE_SIZE
+jobs are in flight, new submissions are rejected with PoolBusyError so the
+API can answer 503 instead of letting requests pile up.
+"""
+
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, Dict, Optional
+
+import face_processing
+
+
+class PoolBusyError(Exception):
+    """Raised when the pool queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class InferencePool:
+    """Bounded executor for model inference jobs"""
+
+    def __init__(self):
+        self.mode = os.getenv('INFERENCE_MODE', 'thread').lower()
+        self.workers = max(1, int(os.getenv('INFERENCE_WORKERS', str(min(4, os.cpu_count() or 1)))))
+        self.queue_size = max(0, int(os.getenv('INFERENCE_QUEUE_SIZE', str(self.workers * 2))))
+        # Rough seconds per job, used for the Retry-After hint
+        self.job_seconds = float(os.getenv('INFERENCE_JOB_SECONDS', '3'))
+
+        self.executor = None
+        self.ready = False
+        self.models = {"model_loaded": False, "mediapipe_loaded": False}
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_size
+
+    def start(self, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        """
+        Create the executor (call from startup event)
+        initializer runs once in every worker process (process mode only;
+        thread workers share the API process state)
+        """
+        if self.mode == 'process':
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=initializer,
+                initargs=initargs
+            )
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inference')
+        print(f"Inference pool started: {self.workers} {self.mode} workers, queue {self.queue_size}")
+
+    async def warmup(self):
+        """Load models in every worker so the first requests don't pay for it"""
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self.executor, face_processing.warmup)
+            for _ in range(self.workers)
+        ])
+        self.models = {
+            "model_loaded": all(r["model_loaded"] for r in results),
+            "mediapipe_loaded": all(r["mediapipe_loaded"] for r in results),
+        }
+        self.ready = True
+        print("Inference workers ready!")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.ready = False
+
+    def retry_after(self) -> int:
+        """Estimate seconds until a slot frees up"""
+        waves = self._pending / self.workers
+        return max(1, int(waves * self.job_seconds + 0.5))
+
+    def reserve(self, count: int = 1):
+        """Reserve queue slots or raise PoolBusyError"""
+        if self.executor is None:
+            raise RuntimeError("Inference pool is not started")
+        if self._pending + count > self.capacity:
+            self._rejected += 1
+            raise PoolBusyError(self.retry_after())
+        self._pending += count
+
+    def release(self, count: int = 1):
+        self._pending -= count
+        self._completed += count
+
+    async def run_reserved(self, fn: Callable, *args):
+        """Run a job in a slot already taken with reserve(); the slot is released after"""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            self.release()
+
+    async def run(self, fn: Callable, *args):
+        """Run fn(*args) in the pool; raises PoolBusyError if the queue is full"""
+        self.reserve()
+        return await self.run_reserved(fn, *args)
+
+    def stats(self) -> Dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "pending": self._pending,
+            "completed": self._completed,
+            "rejected": self._rejected,
+        }
+
+
+# Global singleton
+inference_pool = InferencePool()
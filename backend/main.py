@@ -4,28 +4,33 @@ Simple FastAPI server using rembg for background removal
 With face detection using MediaPipe for accurate eye-based positioning
 """
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body
+from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, JSONResponse
-from fastapi.staticfiles import StaticFiles
-from rembg import remove, new_session
-from PIL import Image
-import cv2
-import numpy as np
-import mediapipe as mp
-from mediapipe.tasks import python
-from mediapipe.tasks.python import vision
-import io
+from fastapi.responses import Response, JSONResponse, RedirectResponse
 import asyncio
 import base64
 import os
 import json
-import urllib.request
 from datetime import datetime
+from collections import OrderedDict
+from typing import List, Optional
 from zoneinfo import ZoneInfo
+from PIL import Image
 import secrets
+import io
 
 from email_service import email_service
+from email_outbox import email_outbox
+from inference_pool import inference_pool, PoolBusyError
+from result_cache import ResultCache
+from recent_collages import recent_collages
+from collage_storage import CollageStorage
+from collage_ids import collage_ids
+import face_processing
+import collage_renderer
+import collage_assets
+import collage_variants
+import uploads_server
 
 app = FastAPI(title="Background Removal API")
 
@@ -36,6 +41,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Face-Id", "X-Face-Info", "X-Image-Width", "X-Image-Height", "Retry-After"],
 )
 
 # Create uploads directory if it doesn't exist
@@ -46,6 +52,20 @@ os.makedirs(UPLOADS_DIR, exist_ok=True)
 SETTINGS_FILE = os.path.join(os.path.dirname(__file__), "settings.json")
 TUMBLER_PASSWORD = "Pass"
 
+# Max images accepted by /process-faces in one request. A batch reserves all
+# its pool slots at once, so a larger one could never be accepted (503 forever)
+MAX_BATCH_FILES = min(int(os.getenv('MAX_BATCH_FILES', '4')), inference_pool.capacity)
+
+# Response formats of /process-face and /process-faces
+# meta: face info and faceId only, for clients that render on the server
+RESPONSE_FORMATS = ('json', 'binary', 'meta')
+
+# Saved collages: size limit and accepted content types (-> file extension)
+MAX_COLLAGE_BYTES = int(os.getenv('MAX_COLLAGE_MB', '20')) * 1024 * 1024
+COLLAGE_TYPES = {'image/png': 'png', 'image/webp': 'webp'}
+# Streamed uploads are written to disk in blocks of this size
+UPLOAD_WRITE_BLOCK = 1024 * 1024
+
 def load_settings():
     if os.path.exists(SETTINGS_FILE):
         with open(SETTINGS_FILE, 'r') as f:
@@ -56,224 +76,380 @@ def save_settings(settings):
     with open(SETTINGS_FILE, 'w') as f:
         json.dump(settings, f)
 
-# Mount static files for serving uploaded collages
-app.mount("/uploads", StaticFiles(directory=UPLOADS_DIR), name="uploads")
-
-# Pre-load models on startup
-session = None
-face_landmarker = None
-face_cascade = None  # Fallback
-
-# MediaPipe face landmarks indices for eyes
-# https://github.com/google/mediapipe/blob/master/mediapipe/modules/face_geometry/data/canonical_face_model_uv_visualization.png
-LEFT_EYE_CENTER = 468  # Left iris center
-RIGHT_EYE_CENTER = 473  # Right iris center
-# Fallback eye corners
-LEFT_EYE_OUTER = 33
-LEFT_EYE_INNER = 133
-RIGHT_EYE_OUTER = 362
-RIGHT_EYE_INNER = 263
-
-MODEL_PATH = os.path.join(os.path.dirname(__file__), "face_landmarker.task")
-MODEL_URL = "https://storage.googleapis.com/mediapipe-models/face_landmarker/face_landmarker/float16/1/face_landmarker.task"
-
-def download_model():
-    """Download MediaPipe face landmarker model if not exists"""
-    if not os.path.exists(MODEL_PATH):
-        print(f"Downloading MediaPipe model to {MODEL_PATH}...")
-        urllib.request.urlretrieve(MODEL_URL, MODEL_PATH)
-        print("Model downloaded!")
+# Cache of processed faces, keyed by upload hash
+result_cache = ResultCache(UPLOADS_DIR)
+# Saved collages and their variants (date-sharded, indexed, with retention)
+collage_storage = CollageStorage(UPLOADS_DIR)
+
+# Background variant jobs (optimized copies + thumbnails) by collage filename
+variant_jobs = {}
+# Collages whose variants could not be generated (e.g. corrupt image); they are
+# served as stored instead of being re-encoded on every request
+variant_failures = OrderedDict()
+
+def pool_busy_response(e: PoolBusyError):
+    return JSONResponse(
+        {"detail": "Сервер перегружен, попробуйте ещё раз через несколько секунд"},
+        status_code=503,
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def face_result_json(result):
+    """Build /process-face JSON payload from a face_processing result"""
+    image_base64 = base64.b64encode(result["data"]).decode('utf-8')
+    return {
+        "image": f"data:{result['media_type']};base64,{image_base64}",
+        "faceId": result["id"],
+        "face": result["face"],
+        "width": result["width"],
+        "height": result["height"]
+    }
+
+def face_result_meta(result):
+    """Face metadata without the image (format=meta, render-collage clients)"""
+    return {
+        "faceId": result["id"],
+        "face": result["face"],
+        "width": result["width"],
+        "height": result["height"]
+    }
+
+def face_result_headers(result):
+    """Metadata headers for binary /process-face responses"""
+    return {
+        "X-Face-Id": result["id"],
+        "X-Face-Info": json.dumps(result["face"]),
+        "X-Image-Width": str(result["width"]),
+        "X-Image-Height": str(result["height"])
+    }
+
+def face_results_multipart(results):
+    """
+    Encode batch results as multipart/form-data so browsers can read them
+    with Response.formData(): a 'results' JSON part plus one file per image
+    """
+    boundary = secrets.token_hex(16)
+    meta = [face_result_meta(r) for r in results]
+
+    parts = [
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="results"\r\n'
+        f'Content-Type: application/json\r\n\r\n'.encode() + json.dumps(meta).encode() + b'\r\n'
+    ]
+    for i, r in enumerate(results):
+        extension = r["media_type"].split('/')[1]
+        parts.append(
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="image-{i}"; filename="face-{i}.{extension}"\r\n'
+            f'Content-Type: {r["media_type"]}\r\n\r\n'.encode() + r["data"] + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+
+    return Response(
+        content=b''.join(parts),
+        media_type=f"multipart/form-data; boundary={boundary}"
+    )
+
+def check_response_options(response_format, encoding, quality=face_processing.DEFAULT_QUALITY):
+    if response_format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format '{response_format}'")
+    if encoding not in face_processing.ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"Unknown encoding '{encoding}'")
+    if quality not in face_processing.SEGMENTATION_BACKENDS:
+        raise HTTPException(status_code=400, detail=f"Unknown quality '{quality}'")
+
+async def process_uploads(uploads, encoding, quality):
+    """
+    Process face uploads, serving repeats from the result cache
+    Pool slots for all cache misses are reserved at once, so a batch is never half-accepted
+    """
+    version = face_processing.cache_version(encoding, quality)
+    keys = [ResultCache.make_key(contents, version) for contents in uploads]
+    results = [await asyncio.to_thread(result_cache.get, key) for key in keys]
+
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        inference_pool.reserve(len(misses))
+        processed = await asyncio.gather(*[
+            inference_pool.run_reserved(face_processing.process_face, uploads[i], encoding, quality)
+            for i in misses
+        ])
+        for i, result in zip(misses, processed):
+            # Cache key doubles as the face ID used by /render-collage
+            result["id"] = keys[i]
+            results[i] = result
+            await asyncio.to_thread(result_cache.put, keys[i], result)
+
+    return results
 
 @app.on_event("startup")
 async def startup_event():
-    global session, face_landmarker, face_cascade
-    print("Loading rembg model...")
-    session = new_session("u2net")
-
-    print("Loading MediaPipe face landmarker model...")
-    try:
-        download_model()
-        base_options = python.BaseOptions(model_asset_path=MODEL_PATH)
-        options = vision.FaceLandmarkerOptions(
-            base_options=base_options,
-            output_face_blendshapes=False,
-            output_facial_transformation_matrixes=False,
-            num_faces=1
-        )
-        face_landmarker = vision.FaceLandmarker.create_from_options(options)
-        print("MediaPipe model loaded!")
-    except Exception as e:
-        print(f"Failed to load MediaPipe: {e}")
-        face_landmarker = None
+    # Plates and frame for /render-collage are scaled once into shared memory,
+    # process workers map the same block
+    assets_manifest = await asyncio.to_thread(collage_assets.init_registry)
 
-    print("Loading fallback face cascade...")
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    print("All models loaded!")
+    # Models are loaded per worker inside the inference pool
+    inference_pool.start(initializer=collage_assets.attach_registry, initargs=(assets_manifest,))
+    await inference_pool.warmup()
 
-@app.get("/health")
-async def health_check():
-    return {"status": "ok", "model_loaded": session is not None, "mediapipe_loaded": face_landmarker is not None}
+    # Background email delivery (resumes jobs left from a previous run)
+    await email_outbox.start()
 
-def detect_face_with_eyes(image_bytes):
-    """
-    Detect face and eye positions using MediaPipe
-    Returns face bounding box and eye centers as percentages
-    """
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    height, width = img.shape[:2]
+    # Collage storage: moves files from the old flat layout, then applies retention periodically
+    await collage_storage.start()
 
-    # Try MediaPipe first
-    if face_landmarker is not None:
-        try:
-            # Convert BGR to RGB
-            rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_img)
-
-            # Detect face landmarks
-            result = face_landmarker.detect(mp_image)
-
-            if result.face_landmarks and len(result.face_landmarks) > 0:
-                landmarks = result.face_landmarks[0]
-
-                # Get eye centers
-                # Try iris landmarks first (more accurate)
-                try:
-                    left_eye = landmarks[LEFT_EYE_CENTER]
-                    right_eye = landmarks[RIGHT_EYE_CENTER]
-                    left_eye_x, left_eye_y = left_eye.x, left_eye.y
-                    right_eye_x, right_eye_y = right_eye.x, right_eye.y
-                except (IndexError, AttributeError):
-                    # Fallback to eye corner midpoints
-                    left_outer = landmarks[LEFT_EYE_OUTER]
-                    left_inner = landmarks[LEFT_EYE_INNER]
-                    right_outer = landmarks[RIGHT_EYE_OUTER]
-                    right_inner = landmarks[RIGHT_EYE_INNER]
-
-                    left_eye_x = (left_outer.x + left_inner.x) / 2
-                    left_eye_y = (left_outer.y + left_inner.y) / 2
-                    right_eye_x = (right_outer.x + right_inner.x) / 2
-                    right_eye_y = (right_outer.y + right_inner.y) / 2
-
-                # Calculate eye center and distance
-                eye_center_x = (left_eye_x + right_eye_x) / 2
-                eye_center_y = (left_eye_y + right_eye_y) / 2
-                eye_distance = np.sqrt(
-                    (right_eye_x - left_eye_x) ** 2 +
-                    (right_eye_y - left_eye_y) ** 2
-                )
-
-                # Get face bounding box from landmarks
-                x_coords = [lm.x for lm in landmarks]
-                y_coords = [lm.y for lm in landmarks]
-
-                min_x, max_x = min(x_coords), max(x_coords)
-                min_y, max_y = min(y_coords), max(y_coords)
-
-                return {
-                    "x": min_x,
-                    "y": min_y,
-                    "width": max_x - min_x,
-                    "height": max_y - min_y,
-                    "found": True,
-                    "eyes": {
-                        "left": {"x": left_eye_x, "y": left_eye_y},
-                        "right": {"x": right_eye_x, "y": right_eye_y},
-                        "center": {"x": eye_center_x, "y": eye_center_y},
-                        "distance": eye_distance
-                    }
-                }
-        except Exception as e:
-            print(f"MediaPipe detection failed: {e}")
-
-    # Fallback to Haar cascade
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-
-    if len(faces) > 0:
-        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
-
-        # Estimate eye positions (roughly 35% from top, 30% and 70% from left)
-        eye_y = (y + h * 0.35) / height
-        left_eye_x = (x + w * 0.3) / width
-        right_eye_x = (x + w * 0.7) / width
-
-        return {
-            "x": x / width,
-            "y": y / height,
-            "width": w / width,
-            "height": h / height,
-            "found": True,
-            "eyes": {
-                "left": {"x": left_eye_x, "y": eye_y},
-                "right": {"x": right_eye_x, "y": eye_y},
-                "center": {"x": (left_eye_x + right_eye_x) / 2, "y": eye_y},
-                "distance": (right_eye_x - left_eye_x),
-                "estimated": True
-            }
-        }
+@app.on_event("shutdown")
+async def shutdown_event():
+    await email_outbox.stop()
+    await collage_storage.stop()
+    inference_pool.shutdown()
+    collage_assets.close_registry()
+    email_service.pool.close_all()
 
-    return {"found": False}
+@app.get("/health")
+async def health_check():
+    return {
+        "status": "ok",
+        "model_loaded": inference_pool.ready and inference_pool.models["model_loaded"],
+        "mediapipe_loaded": inference_pool.models["mediapipe_loaded"],
+        "inference": inference_pool.stats(),
+        "segmentation": {
+            "default": face_processing.DEFAULT_QUALITY,
+            "backends": face_processing.SEGMENTATION_BACKENDS,
+        },
+        "cache": result_cache.stats(),
+        "storage": await asyncio.to_thread(collage_storage.stats)
+    }
 
 @app.post("/remove-background")
-async def remove_background_simple(file: UploadFile = File(...)):
+async def remove_background_simple(file: UploadFile = File(...), encoding: str = 'png',
+                                   quality: str = face_processing.DEFAULT_QUALITY):
     """
     Remove background from uploaded image
-    Returns PNG with transparent background
+    Returns PNG (or WebP, see ?encoding=) with transparent background
+    quality: fast | balanced | best (segmentation model, see SEGMENTATION_BACKENDS)
     """
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
+    check_response_options('binary', encoding, quality)
 
     try:
         contents = await file.read()
-        input_image = Image.open(io.BytesIO(contents))
-        output_image = remove(input_image, session=session)
-
-        output_buffer = io.BytesIO()
-        output_image.save(output_buffer, format="PNG", quality=95)
-        output_buffer.seek(0)
+        data, media_type = await inference_pool.run(face_processing.remove_background, contents, encoding, quality)
 
         return Response(
-            content=output_buffer.getvalue(),
-            media_type="image/png"
+            content=data,
+            media_type=media_type
         )
+    except PoolBusyError as e:
+        return pool_busy_response(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/process-face")
-async def process_face(file: UploadFile = File(...)):
+async def process_face(file: UploadFile = File(...), format: str = 'json', encoding: str = 'png',
+                       quality: str = face_processing.DEFAULT_QUALITY):
     """
     Remove background and detect face position with eye landmarks
-    Returns JSON with base64 image, face coordinates, and eye positions
+    format=json: JSON with base64 image, face coordinates, and eye positions
+    format=binary: raw image body, face info in X-Face-Info header (JSON)
+    format=meta: JSON with faceId and face info only (see /render-collage)
+    encoding: png | webp | webp-lossless
+    quality: fast | balanced | best (segmentation model, see SEGMENTATION_BACKENDS)
     """
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
+    check_response_options(format, encoding, quality)
 
     try:
         contents = await file.read()
+        result, = await process_uploads([contents], encoding, quality)
+
+        if format == 'binary':
+            return Response(
+                content=result["data"],
+                media_type=result["media_type"],
+                headers=face_result_headers(result)
+            )
+        if format == 'meta':
+            return JSONResponse(face_result_meta(result))
+        return JSONResponse(face_result_json(result))
+    except PoolBusyError as e:
+        return pool_busy_response(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Detect face and eyes BEFORE removing background (better detection on original)
-        face_info = detect_face_with_eyes(contents)
+@app.post("/process-faces")
+async def process_faces(files: List[UploadFile] = File(...), format: str = 'json', encoding: str = 'png',
+                        quality: str = face_processing.DEFAULT_QUALITY):
+    """
+    Batch version of /process-face: all images are processed concurrently
+    format=json: JSON with 'results' in the same order as the uploaded files
+    format=binary: multipart/form-data with a 'results' JSON part and 'image-N' files
+    format=meta: JSON with 'results' holding faceId and face info only
+    """
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"Too many files (max {MAX_BATCH_FILES})")
+    for file in files:
+        if not file.content_type.startswith("image/"):
+            raise HTTPException(status_code=400, detail="File must be an image")
+    check_response_options(format, encoding, quality)
 
-        # Remove background
-        input_image = Image.open(io.BytesIO(contents))
-        output_image = remove(input_image, session=session)
+    try:
+        uploads = [await file.read() for file in files]
+        results = await process_uploads(uploads, encoding, quality)
+
+        if format == 'binary':
+            return face_results_multipart(results)
+        if format == 'meta':
+            return JSONResponse({"results": [face_result_meta(r) for r in results]})
+        return JSONResponse({"results": [face_result_json(r) for r in results]})
+    except PoolBusyError as e:
+        return pool_busy_response(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Convert to base64
-        output_buffer = io.BytesIO()
-        output_image.save(output_buffer, format="PNG", quality=95)
-        output_buffer.seek(0)
+def collage_public_url(filename):
+    """Download link for emails and the sheet: the stored full-quality file, not a lossy variant"""
+    return f"{os.getenv('PUBLIC_URL', 'https://seletti-hybrid.de-light.ru')}/uploads/{filename}?size=original"
 
-        image_base64 = base64.b64encode(output_buffer.getvalue()).decode('utf-8')
+def read_stored_collage(filename):
+    """
+    Read a collage saved by /save-collage (memory first, then storage)
+    Returns None if the name is invalid or the collage is missing
+    """
+    if not filename or os.path.basename(filename) != filename or not filename.startswith('collage_'):
+        return None
+    image_bytes = recent_collages.get(filename)
+    if image_bytes is not None:
+        return image_bytes
+    return collage_storage.read(filename)
+
+def collage_extension(head):
+    """File extension from the leading bytes of a PNG or WebP image, None otherwise"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def is_complete_image(source):
+    """
+    Check a path or file object holds an intact image (blocking)
+    verify() walks the chunks without decoding, so truncated files are caught
+    before they are stored
+    """
+    try:
+        with Image.open(source) as image:
+            image.verify()
+        return True
+    except Exception:
+        return False
+
+def new_collage_filename(extension='png'):
+    timestamp = datetime.now(ZoneInfo('Europe/Moscow')).strftime('%Y%m%d_%H%M%S')
+    random_suffix = secrets.token_hex(4)
+    return f"collage_{timestamp}_{random_suffix}.{extension}"
+
+def collage_saved(filename, image_bytes=None):
+    """
+    Register a collage written to storage (blocking: may reserve IDs in SQLite)
+    Returns the /save-collage response payload
+    """
+    public_url = collage_public_url(filename)
 
-        return JSONResponse({
-            "image": f"data:image/png;base64,{image_base64}",
-            "face": face_info,
-            "width": output_image.width,
-            "height": output_image.height
-        })
+    # Unique sequential collage ID, recorded in the storage index so
+    # /send-email can resolve it from any worker and after a restart
+    collage_id = collage_ids.next_id()
+    collage_storage.set_collage_id(filename, collage_id)
+
+    if image_bytes is not None:
+        recent_collages.put(filename, image_bytes)
+
+    return {
+        "success": True,
+        "url": public_url,
+        "collageId": collage_id,
+        "filename": filename
+    }
+
+def store_collage(image_bytes):
+    """
+    Write collage bytes to storage under a unique filename (blocking)
+    Returns the /save-collage response payload
+    """
+    filename = new_collage_filename(collage_extension(image_bytes[:12]) or 'png')
+    collage_storage.save_bytes(filename, image_bytes)
+    return collage_saved(filename, image_bytes)
+
+async def stream_collage(chunks):
+    """
+    Stream collage bytes (async iterator of chunks) into storage
+    Blocks are written off the event loop to a temporary file in UPLOADS_DIR
+    that is moved into storage once the upload is complete and valid.
+    Returns the filename.
+    """
+    tmp_path = os.path.join(UPLOADS_DIR, f".upload_{secrets.token_hex(8)}.tmp")
+    f = await asyncio.to_thread(open, tmp_path, 'wb')
+    size = 0
+    head = b''
+    block = bytearray()
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > MAX_COLLAGE_BYTES:
+                raise HTTPException(status_code=413, detail="Файл коллажа слишком большой")
+            if len(head) < 12:
+                head += chunk[:12 - len(head)]
+                if len(head) == 12 and collage_extension(head) is None:
+                    raise HTTPException(status_code=415, detail="Ожидается PNG или WebP")
+            block += chunk
+            if len(block) >= UPLOAD_WRITE_BLOCK:
+                await asyncio.to_thread(f.write, block)
+                block = bytearray()
+        if block:
+            await asyncio.to_thread(f.write, block)
+        await asyncio.to_thread(f.close)
+
+        extension = collage_extension(head)
+        if extension is None:
+            raise HTTPException(status_code=415 if size else 400, detail="Ожидается PNG или WebP")
+        if not await asyncio.to_thread(is_complete_image, tmp_path):
+            raise HTTPException(status_code=400, detail="Файл коллажа повреждён")
+        filename = new_collage_filename(extension)
+        await asyncio.to_thread(collage_storage.save_file, filename, tmp_path)
+        return filename
+    except BaseException:
+        f.close()
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+async def build_variants(filename):
+    """Generate optimized copies and thumbnails of a saved collage in the inference pool"""
+    try:
+        image_bytes = await asyncio.to_thread(read_stored_collage, filename)
+        if image_bytes is None:
+            return
+        variants = await inference_pool.run(collage_variants.generate_variants, filename, image_bytes)
+        for name, data in variants.items():
+            await asyncio.to_thread(collage_storage.save_bytes, name, data)
+    except PoolBusyError:
+        # Retried on the next request for this collage
+        print(f"Inference pool busy, variants of {filename} postponed")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        print(f"Failed to build variants of {filename}: {e}")
+        variant_failures[filename] = True
+        while len(variant_failures) > 1000:
+            variant_failures.popitem(last=False)
+    finally:
+        variant_jobs.pop(filename, None)
+
+def schedule_variants(filename):
+    if filename not in variant_jobs and filename not in variant_failures:
+        variant_jobs[filename] = asyncio.create_task(build_variants(filename))
 
 @app.post("/save-collage")
 async def save_collage(data: dict = Body(...)):
@@ -294,44 +470,148 @@ async def save_collage(data: dict = Body(...)):
 
         # Decode base64
         image_bytes = base64.b64decode(image_data)
+        if len(image_bytes) > MAX_COLLAGE_BYTES:
+            raise HTTPException(status_code=413, detail="Файл коллажа слишком большой")
+        if not await asyncio.to_thread(is_complete_image, io.BytesIO(image_bytes)):
+            raise HTTPException(status_code=400, detail="Файл коллажа повреждён")
 
-        # Generate unique filename
-        timestamp = datetime.now(ZoneInfo('Europe/Moscow')).strftime('%Y%m%d_%H%M%S')
-        random_suffix = secrets.token_hex(4)
-        filename = f"collage_{timestamp}_{random_suffix}.png"
+        result = await asyncio.to_thread(store_collage, image_bytes)
+        schedule_variants(result["filename"])
+        return JSONResponse(result)
 
-        # Save locally
-        filepath = os.path.join(UPLOADS_DIR, filename)
-        with open(filepath, 'wb') as f:
-            f.write(image_bytes)
-
-        public_url = f"{os.getenv('PUBLIC_URL', 'https://seletti-hybrid.de-light.ru')}/uploads/{filename}"
-
-        # Simple collage ID from timestamp
-        collage_id = int(datetime.now(ZoneInfo('Europe/Moscow')).strftime('%y%m%d%H%M%S'))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        return JSONResponse({
-            "success": True,
-            "url": public_url,
-            "collageId": collage_id,
-            "filename": filename
-        })
+@app.post("/save-collage/upload")
+async def save_collage_upload(request: Request):
+    """
+    Save collage image sent as a binary body instead of base64 JSON
+    Expects the raw image (Content-Type: image/png or image/webp); the body
+    is streamed to disk with MAX_COLLAGE_BYTES enforced while it arrives
+    Returns the same JSON as /save-collage
+    """
+    content_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    content_length = request.headers.get('content-length', '')
+    # Reject oversized bodies up front
+    if content_length.isdigit() and int(content_length) > MAX_COLLAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Файл коллажа слишком большой")
+    if content_type not in COLLAGE_TYPES and content_type not in ('', 'application/octet-stream'):
+        raise HTTPException(status_code=415, detail="Ожидается PNG или WebP")
+
+    filename = await stream_collage(request.stream())
+    schedule_variants(filename)
+    return JSONResponse(await asyncio.to_thread(collage_saved, filename))
+
+def select_face(result, index):
+    """Processed face result with face info replaced by the index-th ranked face (None if out of range)"""
+    if index == 0:
+        return result
+    faces = result["face"].get("faces", [])
+    if not 0 <= index < len(faces):
+        return None
+    return {**result, "face": faces[index]}
+
+@app.post("/render-collage")
+async def render_collage(data: dict = Body(...)):
+    """
+    Render collage on the server from two processed faces and save it
+    Expects JSON with 'faces' ([faceId, faceId] from /process-face) and 'plate' (0-5)
+    Optional 'faceIndex' ([i, j]) picks another detected person from face info 'faces'
+    (ranked list, FACE_MAX_FACES > 1) without re-uploading; default is the best face
+    Returns the same JSON as /save-collage
+    """
+    face_ids = data.get('faces', [])
+    plate_index = data.get('plate')
+    face_indexes = data.get('faceIndex', [0, 0])
+
+    if len(face_ids) != 2:
+        raise HTTPException(status_code=400, detail="Expected two face IDs")
+    if (not isinstance(face_indexes, list) or len(face_indexes) != 2
+            or not all(isinstance(i, int) for i in face_indexes)):
+        raise HTTPException(status_code=400, detail="Invalid face index")
+    if not isinstance(plate_index, int) or not 0 <= plate_index < collage_assets.PLATE_COUNT:
+        raise HTTPException(status_code=400, detail="Invalid plate index")
+
+    faces = [await asyncio.to_thread(result_cache.get, face_id) for face_id in face_ids]
+    if any(face is None for face in faces):
+        raise HTTPException(status_code=404, detail="Обработанные фото не найдены, загрузите их заново")
+    faces = [select_face(face, index) for face, index in zip(faces, face_indexes)]
+    if any(face is None for face in faces):
+        raise HTTPException(status_code=400, detail="Invalid face index")
 
+    try:
+        image_bytes = await inference_pool.run(collage_renderer.render_collage, faces[0], faces[1], plate_index)
+        result = await asyncio.to_thread(store_collage, image_bytes)
+        schedule_variants(result["filename"])
+        return JSONResponse(result)
+    except PoolBusyError as e:
+        return pool_busy_response(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def serve_stored(request, key, media_type=None, immutable=True, headers=None):
+    """Serve a stored object from local storage, or redirect to the remote backend"""
+    if collage_storage.root is not None:
+        return await uploads_server.serve_file(request, collage_storage.root, key, media_type, immutable, headers)
+    return RedirectResponse(collage_storage.url(key), headers={"Cache-Control": uploads_server.SHORT_CACHE})
+
+@app.api_route("/uploads/{filename}", methods=["GET", "HEAD"])
+async def get_upload(filename: str, request: Request, size: Optional[str] = None):
+    """
+    Serve a saved collage
+    Returns a WebP (if the Accept header allows it) or JPEG variant:
+    ?size=<width> for the nearest thumbnail, ?size=original for the stored file
+    Falls back to the original until the variants are generated
+    Responses are cacheable (immutable, ETag, 304) and support byte ranges
+    """
+    if os.path.basename(filename) != filename or not filename.startswith('collage_'):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    if not collage_variants.is_variant(filename):
+        try:
+            candidates = collage_variants.select_variants(filename, request.headers.get('accept', ''), size)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid size")
+        for name, media_type in candidates:
+            key = await asyncio.to_thread(collage_storage.locate, name)
+            if key is not None:
+                return await serve_stored(request, key, media_type, headers={"Vary": "Accept"})
+        key = await asyncio.to_thread(collage_storage.locate, filename)
+        if candidates and key is not None:
+            schedule_variants(filename)
+            # Short-lived: the same URL serves a variant once it exists
+            return await serve_stored(request, key, immutable=False, headers={"Vary": "Accept"})
+    else:
+        key = await asyncio.to_thread(collage_storage.locate, filename)
+
+    if key is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return await serve_stored(request, key, headers={"Vary": "Accept"})
+
 @app.post("/send-email")
 async def send_email(data: dict = Body(...)):
     """
-    Send collage email via SMTP
-    Expects JSON with 'image' (data URL) and 'recipients' ([{email, customerType}])
+    Queue collage email for SMTP delivery
+    Expects JSON with 'recipients' ([{email, customerType}]) and a collage reference:
+    'filename' or 'collageId' returned by /save-collage (preferred, nothing is re-uploaded)
+    or 'image' (data URL)
+    Returns as soon as the job is stored; poll /send-email/{jobId} for delivery status
     """
     try:
         image_data = data.get('image', '')
+        filename = data.get('filename', '')
+        collage_id = data.get('collageId')
+        if not filename and collage_id is not None:
+            try:
+                filename = await asyncio.to_thread(collage_storage.filename_for, int(collage_id)) or ''
+            except (TypeError, ValueError):
+                filename = ''
         recipients = data.get('recipients', [])
         collage_info = data.get('collageInfo', None)
 
-        if not image_data:
+        if not image_data and not filename and collage_id is None:
             return JSONResponse({'success': False, 'message': 'Изображение не предоставлено', 'results': []})
 
         if not recipients:
@@ -340,32 +620,46 @@ async def send_email(data: dict = Body(...)):
         if not email_service.is_configured():
             return JSONResponse({'success': False, 'message': 'SMTP не настроен. Обратитесь к администратору.', 'results': []})
 
-        # Remove data URL prefix
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-
-        image_bytes = base64.b64decode(image_data)
+        if filename or collage_id is not None:
+            image_bytes = await asyncio.to_thread(read_stored_collage, filename)
+            if image_bytes is None:
+                return JSONResponse({'success': False, 'message': 'Коллаж не найден', 'results': []}, status_code=404)
+            collage_url = collage_public_url(filename)
+        else:
+            # Remove data URL prefix
+            if ',' in image_data:
+                image_data = image_data.split(',')[1]
 
-        # Run blocking SMTP in a thread
-        results = await asyncio.to_thread(email_service.send_to_multiple, recipients, image_bytes)
+            image_bytes = base64.b64decode(image_data)
+            collage_url = (collage_info or {}).get('url')
 
-        # Send manager notification in background (don't block the response)
-        asyncio.create_task(
-            asyncio.to_thread(email_service.send_manager_notification, image_bytes, recipients, collage_info)
-        )
-
-        all_ok = all(r['success'] for r in results)
+        # Queue for background delivery; workers retry failed sends
+        job_id = await asyncio.to_thread(email_outbox.enqueue, image_bytes, recipients, collage_info, collage_url)
+        email_outbox.wake()
 
         return JSONResponse({
-            'success': all_ok,
-            'results': results,
-            'message': 'Все письма отправлены' if all_ok else 'Некоторые письма не удалось отправить'
+            'success': True,
+            'queued': True,
+            'jobId': job_id,
+            'results': [
+                {'email': r.get('email', ''), 'success': True, 'message': 'Письмо поставлено в очередь'}
+                for r in recipients
+            ],
+            'message': 'Письма поставлены в очередь на отправку'
         })
 
     except Exception as e:
         return JSONResponse({'success': False, 'message': str(e), 'results': []}, status_code=500)
 
 
+@app.get("/send-email/{job_id}")
+async def send_email_status(job_id: str):
+    """Delivery status of a queued /send-email job"""
+    status = await asyncio.to_thread(email_outbox.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(status)
+
 @app.get("/print-button-setting")
 async def get_print_button_setting():
     settings = load_settings()
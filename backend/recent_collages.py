@@ -0,0 +1,48 @@
+"""
+Recent Collages
+In-memory copies of recently saved collages
+
+/send-email references a collage by filename or collageId; the bytes of
+collages saved by this process are served from here instead of being read
+back from storage. Bounded by RECENT_COLLAGES_MAX_MB, least recently used
+first out. Anything not here is read from collage storage.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class RecentCollages:
+    """LRU of collage bytes by filename, bounded by total size"""
+
+    def __init__(self):
+        self.max_bytes = int(os.getenv('RECENT_COLLAGES_MAX_MB', '64')) * 1024 * 1024
+        self._images = OrderedDict()  # filename -> bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, filename: str, image_bytes: bytes):
+        if len(image_bytes) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._images.pop(filename, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._images[filename] = image_bytes
+            self._bytes += len(image_bytes)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def get(self, filename: str) -> Optional[bytes]:
+        with self._lock:
+            image_bytes = self._images.get(filename)
+            if image_bytes is not None:
+                self._images.move_to_end(filename)
+            return image_bytes
+
+
+# Global singleton
+recent_collages = RecentCollages()
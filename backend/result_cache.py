@@ -0,0 +1,161 @@
+"""
+Result Cache
+Content-addressed cache of processed faces (cutout + face info)
+
+Keys are a hash of the upload bytes plus the model/parameter version, so
+re-takes, restored sessions and network retries of the same photo skip
+inference. Two tiers:
+- memory: LRU bounded by total cutout bytes
+- disk (optional): one file per key, evicted by TTL
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class ResultCache:
+    """Two-tier (memory LRU + disk TTL) cache for /process-face results"""
+
+    def __init__(self, uploads_dir: str):
+        self.max_bytes = int(os.getenv('FACE_CACHE_MAX_MB', '128')) * 1024 * 1024
+        self.disk_enabled = os.getenv('FACE_CACHE_DISK', 'false').lower() in ('true', '1', 'yes')
+        self.disk_dir = os.getenv('FACE_CACHE_DIR', os.path.join(uploads_dir, '.face-cache'))
+        self.ttl = int(os.getenv('FACE_CACHE_TTL_HOURS', '24')) * 3600
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_enabled:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(contents: bytes, version: str) -> str:
+        """Hash of upload bytes + processing version"""
+        digest = hashlib.sha256(contents)
+        digest.update(b'\0' + version.encode())
+        return digest.hexdigest()
+
+    # --- memory tier ---
+
+    def _memory_get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+            return result
+
+    def _memory_put(self, key: str, result: Dict):
+        size = len(result["data"])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old["data"])
+            self._memory[key] = result
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted["data"])
+
+    # --- disk tier ---
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.bin")
+
+    def _disk_get(self, key: str) -> Optional[Dict]:
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                meta_line = f.readline()
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            result = json.loads(meta_line)
+        except ValueError:
+            result = None
+        if not isinstance(result, dict):
+            # Corrupt entry (e.g. truncated write): drop it and treat as a miss
+            print(f"Face cache: removing corrupt entry {key}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        result["data"] = data
+        return result
+
+    def _disk_put(self, key: str, result: Dict):
+        meta = {k: v for k, v in result.items() if k != "data"}
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps(meta).encode() + b'\n')
+                f.write(result["data"])
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write face cache entry: {e}")
+        self._maybe_sweep()
+
+    def _maybe_sweep(self):
+        """Remove expired disk entries, at most once per 10 minutes"""
+        now = time.time()
+        if now - self._last_sweep < 600:
+            return
+        self._last_sweep = now
+        removed = 0
+        for entry in os.scandir(self.disk_dir):
+            try:
+                if entry.name.endswith('.bin') and now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"Face cache: removed {removed} expired entries")
+
+    # --- public API (blocking; call disk paths via asyncio.to_thread) ---
+
+    def get(self, key: str) -> Optional[Dict]:
+        result = self._memory_get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        if self.disk_enabled:
+            result = self._disk_get(key)
+            if result is not None:
+                self.disk_hits += 1
+                self._memory_put(key, result)
+                return result
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result: Dict):
+        self._memory_put(key, result)
+        if self.disk_enabled:
+            self._disk_put(key, result)
+
+    def stats(self) -> Dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_enabled": self.disk_enabled,
+        }
@@ -0,0 +1,148 @@
+"""
+Uploads Server
+HTTP caching and range handling for files served from UPLOADS_DIR
+
+Saved collages have unique names and never change, so responses are sent with
+a long immutable Cache-Control. Every response carries ETag/Last-Modified and
+conditional requests are answered with 304. Single byte ranges get 206.
+Full bodies go through FileResponse (zero-copy when the ASGI server supports
+the pathsend extension) or, with UPLOADS_ACCEL_REDIRECT set, are handed to
+nginx via X-Accel-Redirect so it sends the file itself.
+"""
+
+import os
+import asyncio
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request, HTTPException
+from fastapi.responses import Response, FileResponse, StreamingResponse
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+# For responses that will change once background work finishes
+SHORT_CACHE = 'public, max-age=60'
+
+# Internal nginx location mapped to UPLOADS_DIR, e.g. /internal-uploads/
+ACCEL_REDIRECT = os.getenv('UPLOADS_ACCEL_REDIRECT', '')
+
+CHUNK_SIZE = 256 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def file_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """Evaluate If-None-Match, or If-Modified-Since when there is no If-None-Match"""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single 'bytes=' range into inclusive (start, end)
+    Returns None for ranges that are ignored (other units, multiple ranges),
+    so the full file is sent; raises RangeNotSatisfiable if it is out of bounds
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+async def iter_file_range(path: str, start: int, end: int):
+    """Read [start, end] in chunks off the event loop"""
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+async def serve_file(request: Request, root: str, relpath: str, media_type: Optional[str] = None,
+                     immutable: bool = True, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Serve root/relpath with caching, conditional and range handling
+    The caller validates relpath; a file that is gone (e.g. removed by the
+    retention sweep after it was located) is answered with 404
+    """
+    path = os.path.join(root, relpath)
+    try:
+        stat = await asyncio.to_thread(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not found")
+    media_type = media_type or mimetypes.guess_type(relpath)[0] or 'application/octet-stream'
+    etag = file_etag(stat)
+
+    response_headers = {
+        'Cache-Control': IMMUTABLE_CACHE if immutable else SHORT_CACHE,
+        'ETag': etag,
+        'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+        'Accept-Ranges': 'bytes',
+        **(headers or {}),
+    }
+
+    if is_not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=response_headers)
+
+    byte_range = None
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except RangeNotSatisfiable:
+            response_headers['Content-Range'] = f"bytes */{stat.st_size}"
+            return Response(status_code=416, headers=response_headers)
+
+    if byte_range is not None:
+        start, end = byte_range
+        response_headers['Content-Range'] = f"bytes {start}-{end}/{stat.st_size}"
+        response_headers['Content-Length'] = str(end - start + 1)
+        if request.method == 'HEAD':
+            return Response(status_code=206, headers=response_headers, media_type=media_type)
+        return StreamingResponse(iter_file_range(path, start, end), status_code=206,
+                                 headers=response_headers, media_type=media_type)
+
+    if ACCEL_REDIRECT:
+        # nginx serves the body (sendfile); Content-Type comes from this response
+        response_headers['X-Accel-Redirect'] = ACCEL_REDIRECT.rstrip('/') + '/' + relpath.replace(os.sep, '/')
+        return Response(headers=response_headers, media_type=media_type)
+
+    return FileResponse(path, media_type=media_type, headers=response_headers, stat_result=stat)
@@ -26,6 +26,7 @@ class App {
       photos: [], // Array of captured photo Blobs [left, right]
       selectedPlate: null, // Selected plate index (0, 1, 2)
       collageDataUrl: null, // Final collage as data URL
+      savedCollage: null, // {filename, collageId, url} once stored on the server
       emails: [], // Array of {email, customerType} objects
     };
 
@@ -183,9 +184,27 @@ class App {
   /**
    * Set collage data URL
    * @param {string} dataUrl
+   * @param {?Object} saved - {filename, collageId, url} if the server already stored it
    */
-  setCollage(dataUrl) {
+  setCollage(dataUrl, saved = null) {
     this.state.collageDataUrl = dataUrl;
+    this.state.savedCollage = saved;
+  }
+
+  /**
+   * Remember the server copy of the current collage
+   * @param {{filename: string, collageId: number, url: string}} saved
+   */
+  setSavedCollage(saved) {
+    this.state.savedCollage = saved;
+  }
+
+  /**
+   * Get the server copy of the current collage (null if not saved yet)
+   * @returns {?{filename: string, collageId: number, url: string}}
+   */
+  getSavedCollage() {
+    return this.state.savedCollage;
   }
 
   /**
@@ -220,6 +239,7 @@ class App {
       photos: [],
       selectedPlate: null,
       collageDataUrl: null,
+      savedCollage: null,
       emails: [],
     };
     clearSession();
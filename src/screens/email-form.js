@@ -229,41 +229,47 @@ export class EmailFormScreen {
       }
 
       // First save collage to get ID, URL, datetime for manager notification
-      let collageInfo = null;
-      try {
-        const saveRes = await this._fetchWithTimeout(`${API_URL}/save-collage`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({
-            image: collageDataUrl,
-            email: email1,
-            customerType: customerType1,
-            recipients
-          })
-        }, 90000);
-        if (saveRes.ok) {
-          const result = await saveRes.json();
-          if (result.success) {
-            collageInfo = {
-              collageId: result.collageId,
-              url: result.url,
-              datetime: new Date().toLocaleString('ru-RU')
-            };
+      // (skipped when the server already stored it while rendering)
+      let saved = this.app.getSavedCollage();
+      if (!saved) {
+        try {
+          // Upload the image as binary instead of a base64 JSON string
+          const collageBlob = await (await fetch(collageDataUrl)).blob();
+          const saveRes = await this._fetchWithTimeout(`${API_URL}/save-collage/upload`, {
+            method: 'POST',
+            headers: { 'Content-Type': collageBlob.type },
+            body: collageBlob
+          }, 90000);
+          if (saveRes.ok) {
+            const result = await saveRes.json();
+            if (result.success) {
+              saved = { filename: result.filename, collageId: result.collageId, url: result.url };
+              this.app.setSavedCollage(saved);
+            }
           }
+        } catch (err) {
+          console.error('Failed to save collage:', err);
         }
-      } catch (err) {
-        console.error('Failed to save collage:', err);
       }
+      const savedFilename = saved?.filename;
+      const collageInfo = saved ? {
+        collageId: saved.collageId,
+        url: saved.url,
+        datetime: new Date().toLocaleString('ru-RU')
+      } : null;
 
       // Then send email with collageInfo so manager gets full details
+      // Reference the saved collage by filename instead of uploading it again
+      const emailBody = { recipients, collageInfo };
+      if (savedFilename) {
+        emailBody.filename = savedFilename;
+      } else {
+        emailBody.image = collageDataUrl;
+      }
       const emailResponse = await this._fetchWithTimeout(`${API_URL}/send-email`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          image: collageDataUrl,
-          recipients,
-          collageInfo
-        })
+        body: JSON.stringify(emailBody)
       }, 90000);
 
       const emailData = await emailResponse.json();
@@ -148,33 +148,37 @@ export class FinalScreen {
 
     try {
       const collageDataUrl = this.app.getCollage();
-      const primaryEmail = emails[0];
-
-      // Run save-collage and send-email in parallel
-      const savePromise = this._fetchWithTimeout(`${API_URL}/save-collage`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          image: collageDataUrl,
-          email: primaryEmail.email,
-          customerType: primaryEmail.customerType,
-          recipients
-        })
-      }, 90000).then(async (res) => {
-        if (res.ok) {
-          const result = await res.json();
-          if (result.success) return result;
-        }
-        return null;
-      }).catch((err) => {
-        console.error('Failed to save collage:', err);
-        return null;
-      });
 
       const recipients = emails.map(({ email, customerType }) => ({ email, customerType }));
-      const emailPromise = sendCollageToMultiple(recipients, collageDataUrl);
 
-      await Promise.all([savePromise, emailPromise]);
+      // Save first (unless the server or the email form already did), then
+      // reference the saved file so the collage is uploaded only once
+      let saved = this.app.getSavedCollage();
+      if (!saved) {
+        const collageBlob = await (await fetch(collageDataUrl)).blob();
+        saved = await this._fetchWithTimeout(`${API_URL}/save-collage/upload`, {
+          method: 'POST',
+          headers: { 'Content-Type': collageBlob.type },
+          body: collageBlob
+        }, 90000).then(async (res) => {
+          if (res.ok) {
+            const result = await res.json();
+            if (result.success) return { filename: result.filename, collageId: result.collageId, url: result.url };
+          }
+          return null;
+        }).catch((err) => {
+          console.error('Failed to save collage:', err);
+          return null;
+        });
+        if (saved) this.app.setSavedCollage(saved);
+      }
+
+      const collageInfo = saved ? {
+        collageId: saved.collageId,
+        url: saved.url,
+        datetime: new Date().toLocaleString('ru-RU')
+      } : null;
+      await sendCollageToMultiple(recipients, collageDataUrl, collageInfo, saved?.filename);
 
       // Show success message
       this.showSuccessMessage();
@@ -73,7 +73,7 @@ export class ProcessingScreen {
       throw new Error('Тарелка не выбрана');
     }
 
-    const collageDataUrl = await createCollage(
+    const { dataUrl, saved } = await createCollage(
       photos[0],
       photos[1],
       plateIndex,
@@ -95,7 +95,7 @@ export class ProcessingScreen {
       }
     );
 
-    this.app.setCollage(collageDataUrl);
+    this.app.setCollage(dataUrl, saved);
 
     this.updateProgress(100);
     this.updateStatus('Готово!');
@@ -7,6 +7,13 @@
 // API endpoint - through Nginx /api/ proxy
 const API_URL = `${window.location.protocol}//${window.location.hostname}/api`;
 
+// Cutout encoding requested from the backend: png | webp | webp-lossless
+const FACE_ENCODING = 'webp';
+
+// Segmentation quality: fast | balanced | best (empty = backend default)
+const FACE_QUALITY = import.meta.env.VITE_FACE_QUALITY || '';
+const FACE_OPTIONS = `encoding=${FACE_ENCODING}${FACE_QUALITY ? `&quality=${FACE_QUALITY}` : ''}`;
+
 let isApiReady = false;
 
 /**
@@ -49,9 +56,10 @@ export function isModelReady() {
 
 /**
  * Process face: remove background and detect face position
+ * The cutout comes back as a raw binary body, face info in the X-Face-Info header
  * @param {Blob} imageBlob - Input image
  * @param {Function} onProgress - Progress callback (0-100)
- * @returns {Promise<{image: string, face: Object, width: number, height: number}>}
+ * @returns {Promise<{image: string, face: Object, width: number, height: number}>} image is an object URL
  */
 export async function processFace(imageBlob, onProgress = () => {}) {
   try {
@@ -62,7 +70,7 @@ export async function processFace(imageBlob, onProgress = () => {}) {
 
     onProgress(20);
 
-    const response = await fetch(`${API_URL}/process-face`, {
+    const response = await fetch(`${API_URL}/process-face?format=binary&${FACE_OPTIONS}`, {
       method: 'POST',
       body: formData
     });
@@ -81,10 +89,15 @@ export async function processFace(imageBlob, onProgress = () => {}) {
       throw new Error(errorMessage);
     }
 
-    const result = await response.json();
+    const blob = await response.blob();
     onProgress(100);
 
-    return result;
+    return {
+      image: URL.createObjectURL(blob),
+      face: JSON.parse(response.headers.get('X-Face-Info') || '{"found": false}'),
+      width: Number(response.headers.get('X-Image-Width')),
+      height: Number(response.headers.get('X-Image-Height'))
+    };
   } catch (error) {
     console.error('Face processing error:', error);
 
@@ -98,25 +111,98 @@ export async function processFace(imageBlob, onProgress = () => {}) {
 }
 
 /**
- * Process multiple faces
+ * Process multiple faces in a single /process-faces request
+ * The backend runs all images concurrently and returns a multipart/form-data
+ * body: a 'results' JSON part plus one 'image-N' file per photo
+ * With metaOnly the cutouts stay on the server and only faceId/face info is returned
  * @param {Blob[]} images
  * @param {Function} onProgress - Progress callback (0-100, imageIndex)
- * @returns {Promise<Array<{image: string, face: Object, width: number, height: number}>>}
+ * @param {Object} options - { metaOnly: boolean }
+ * @returns {Promise<Array<{image: string, faceId: string, face: Object, width: number, height: number}>>} images are object URLs
  */
-export async function processMultipleFaces(images, onProgress = () => {}) {
-  const results = [];
-  const total = images.length;
-
-  for (let i = 0; i < total; i++) {
-    const imageProgress = (progress) => {
-      const baseProgress = (i / total) * 100;
-      const contribution = (progress / 100) * (100 / total);
-      onProgress(Math.round(baseProgress + contribution), i);
-    };
+export async function processMultipleFaces(images, onProgress = () => {}, { metaOnly = false } = {}) {
+  try {
+    onProgress(10, 0);
+
+    const formData = new FormData();
+    images.forEach((imageBlob, i) => {
+      formData.append('files', imageBlob, `image-${i + 1}.jpg`);
+    });
+
+    onProgress(20, 0);
+
+    const format = metaOnly ? 'meta' : 'binary';
+    const response = await fetch(`${API_URL}/process-faces?format=${format}&${FACE_OPTIONS}`, {
+      method: 'POST',
+      body: formData
+    });
+
+    onProgress(80, images.length - 1);
 
-    const processed = await processFace(images[i], imageProgress);
-    results.push(processed);
+    if (!response.ok) {
+      let errorMessage = 'Ошибка обработки фото';
+      try {
+        const error = await response.json();
+        errorMessage = error.detail || errorMessage;
+      } catch (e) {
+        // Failed to parse JSON error
+        errorMessage = `HTTP ${response.status}: ${response.statusText}`;
+      }
+      throw new Error(errorMessage);
+    }
+
+    if (metaOnly) {
+      const { results } = await response.json();
+      onProgress(100, images.length - 1);
+      return results;
+    }
+
+    const form = await response.formData();
+    const results = JSON.parse(form.get('results')).map((result, i) => ({
+      ...result,
+      image: URL.createObjectURL(form.get(`image-${i}`))
+    }));
+    onProgress(100, images.length - 1);
+
+    return results;
+  } catch (error) {
+    console.error('Face processing error:', error);
+
+    if (error.message.includes('Failed to fetch') || error.name === 'TypeError') {
+      throw new Error(`Сервер обработки не доступен. Проверьте, что backend запущен на ${API_URL}`);
+    }
+
+    throw new Error(error.message || 'Не удалось обработать фото. Попробуйте ещё раз.');
+  }
+}
+
+/**
+ * Render collage on the server from processed face IDs
+ * The server also saves it, so the result carries url/collageId/filename
+ * @param {string[]} faceIds - Two faceId values from processMultipleFaces
+ * @param {number} plateIndex
+ * @param {number[]} faceIndexes - Person to use in each photo, index into face.faces (default: best ranked)
+ * @returns {Promise<{url: string, collageId: number, filename: string, blob: Blob}>}
+ */
+export async function renderCollage(faceIds, plateIndex, faceIndexes = [0, 0]) {
+  const response = await fetch(`${API_URL}/render-collage`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ faces: faceIds, plate: plateIndex, faceIndex: faceIndexes })
+  });
+
+  if (!response.ok) {
+    let errorMessage = 'Ошибка создания коллажа';
+    try {
+      const error = await response.json();
+      errorMessage = error.detail || errorMessage;
+    } catch (e) {
+      errorMessage = `HTTP ${response.status}: ${response.statusText}`;
+    }
+    throw new Error(errorMessage);
   }
 
-  return results;
+  const result = await response.json();
+  const imageResponse = await fetch(`${API_URL}/uploads/${result.filename}?size=original`);
+  return { ...result, blob: await imageResponse.blob() };
 }
@@ -10,7 +10,7 @@
  */
 
 import { loadImage, blobToBase64 } from '../utils/helpers.js';
-import { processMultipleFaces } from './background-removal.js';
+import { processMultipleFaces, renderCollage } from './background-removal.js';
 
 // Import plate images (PNG with transparency)
 import plate1Url from '../assets/plate-1.png';
@@ -23,6 +23,9 @@ import plate6Url from '../assets/plate-6.png';
 // Import background frame
 import backgroundFrameUrl from '../assets/backage.png';
 
+// Render on the backend (/render-collage) instead of the client canvas
+const SERVER_RENDER = import.meta.env.VITE_SERVER_RENDER === 'true';
+
 const PLATE_URLS = [plate1Url, plate2Url, plate3Url, plate4Url, plate5Url, plate6Url];
 
 /**
@@ -43,8 +46,14 @@ const FACE_HEIGHT = 868;     // Face scaling controlled by targetEyeDistance
 
 /**
  * Create the final collage
+ * @returns {Promise<{dataUrl: string, saved: ?{filename: string, collageId: number, url: string}}>}
+ * saved is set when the server already stored the collage (server render)
  */
 export async function createCollage(photo1, photo2, plateIndex, onProgress = () => {}) {
+  if (SERVER_RENDER) {
+    return createCollageOnServer(photo1, photo2, plateIndex, onProgress);
+  }
+
   const canvas = document.createElement('canvas');
   canvas.width = OUTPUT_WIDTH;
   canvas.height = OUTPUT_HEIGHT;
@@ -78,6 +87,10 @@ export async function createCollage(photo1, photo2, plateIndex, onProgress = ()
     loadImage(processedFaces[0].image),
     loadImage(processedFaces[1].image)
   ]);
+  // Cutouts arrive as object URLs - free them once decoded
+  processedFaces.forEach(({ image }) => {
+    if (image.startsWith('blob:')) URL.revokeObjectURL(image);
+  });
 
   onProgress(70);
 
@@ -134,7 +147,28 @@ export async function createCollage(photo1, photo2, plateIndex, onProgress = ()
   onProgress(100);
 
   // Return full canvas - faces are already clipped to plate edge
-  return canvas.toDataURL('image/png');
+  return { dataUrl: canvas.toDataURL('image/png'), saved: null };
+}
+
+/**
+ * Create the collage on the backend: faces stay on the server,
+ * only the finished collage is downloaded
+ */
+async function createCollageOnServer(photo1, photo2, plateIndex, onProgress) {
+  onProgress(5);
+
+  const processedFaces = await processMultipleFaces([photo1, photo2], (progress) => {
+    onProgress(5 + Math.round(progress * 0.55));
+  }, { metaOnly: true });
+
+  onProgress(70);
+
+  const { blob, filename, collageId, url } = await renderCollage(processedFaces.map(f => f.faceId), plateIndex);
+
+  onProgress(100);
+
+  // The server already saved it: keep the reference so it isn't uploaded again
+  return { dataUrl: await blobToBase64(blob), saved: { filename, collageId, url } };
 }
 
 /**
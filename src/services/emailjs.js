@@ -46,15 +46,18 @@ export async function sendCollageEmail(toEmail, collageDataUrl, customerType = '
 /**
  * Send collage email to multiple recipients in a single request
  * @param {Array<{email: string, customerType: string}>} recipients
- * @param {string} collageDataUrl - Collage image as data URL
+ * @param {string} collageDataUrl - Collage image as data URL (used when filename is not given)
  * @param {Object} collageInfo - Collage info for manager notification (optional)
+ * @param {string} filename - Filename returned by /save-collage; the backend reads the saved file (optional)
  * @returns {Promise<Object>}
  */
-export async function sendCollageToMultiple(recipients, collageDataUrl, collageInfo = null) {
-  const body = {
-    image: collageDataUrl,
-    recipients
-  };
+export async function sendCollageToMultiple(recipients, collageDataUrl, collageInfo = null, filename = null) {
+  const body = { recipients };
+  if (filename) {
+    body.filename = filename;
+  } else {
+    body.image = collageDataUrl;
+  }
   if (collageInfo) body.collageInfo = collageInfo;
 
   const response = await fetchWithTimeout(`${API_BASE}/send-email`, {
@@ -91,7 +91,8 @@ export async function saveSession(screenName, state) {
       screen: screenName,
       selectedPlate: state.selectedPlate,
       emails: state.emails,
-      hasCollage: !!state.collageDataUrl
+      hasCollage: !!state.collageDataUrl,
+      savedCollage: state.savedCollage ?? null
     }));
   } catch (e) {
     console.warn('Failed to save session:', e);
@@ -149,6 +150,7 @@ export async function restoreSession() {
         photos,
         selectedPlate: meta.selectedPlate ?? null,
         collageDataUrl: collageDataUrl ?? null,
+        savedCollage: collageDataUrl ? (meta.savedCollage ?? null) : null,
         emails: meta.emails ?? []
       }
     };